@@ -0,0 +1,194 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import queue
+import time
+import traceback
+from multiprocessing import Process, Queue, freeze_support
+
+from pipeline import runPipeline
+from sweep import SWEEP_PARAMETERS, addParameterArguments
+from trcio import _saveAtomically
+
+
+# Batch processing: runs the simulate-and-score pipeline over a whole capture library, one take per process.
+# Takes are handed out largest first to whichever worker slot frees up next, so a few long takes do not end up queued
+# behind many short ones. Every take runs in its own process, which gives a hard per-take timeout (the process is
+# terminated) and keeps a crash in one take from taking down the others.
+# Next to every output TRC a manifest (<name>.json) records the parameters and stats. A take whose output and 'ok'
+# manifest already exist for the same parameters is skipped, so an interrupted batch resumes where it stopped.
+
+SUMMARY_FIELDS = ['take', 'outFilePath', 'status', 'avgError', 'stdError', 'seconds', 'error']
+POLL_INTERVAL = 0.1          # seconds between checks on running takes
+
+
+def findTakes(patterns: list):
+# Expands directories (every .trc file below them) and glob patterns into a list of (take, path) pairs, largest file first.
+# take is the path relative to the directory or the fixed part of the pattern, used to name the outputs. Raises ValueError
+# when two files give the same take (e.g. take.trc in two of the directories), as their outputs would overwrite each other.
+
+    takes = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            root = pattern
+            paths = glob.glob(os.path.join(glob.escape(pattern), '**', '*.trc'), recursive=True)
+        else:
+            root = os.path.dirname(pattern.split('*')[0].split('?')[0].split('[')[0])
+            paths = glob.glob(pattern, recursive=True)
+        for path in paths:
+            if os.path.isfile(path):
+                takes.setdefault(os.path.abspath(path), os.path.relpath(path, root or '.'))
+
+    outputs = {}
+    for path, take in takes.items():
+        output = os.path.normcase(os.path.splitext(take)[0])
+        if output in outputs:
+            raise ValueError('%s and %s both give the take %s, their outputs would overwrite each other: pass their common parent directory instead'
+                             % (outputs[output], path, take))
+        outputs[output] = path
+
+    return sorted(((take, path) for path, take in takes.items()), key=lambda item: os.path.getsize(item[1]), reverse=True)
+
+def manifestPath(outFilePath):
+    return os.path.splitext(outFilePath)[0] + '.json'
+
+def _readManifest(outFilePath):
+# The manifest of a finished take, or None if there is none (or it cannot be read).
+
+    try:
+        with open(manifestPath(outFilePath), 'r') as manifestFile:
+            return json.load(manifestFile)
+    except (OSError, ValueError):
+        return None
+
+def _writeManifest(outFilePath, manifest: dict):
+# Written to a temporary file first: a manifest only exists once it is complete.
+
+    _saveAtomically(manifestPath(outFilePath), lambda manifestFile: manifestFile.write(json.dumps(manifest, indent=2).encode()))
+
+def _runTake(index: int, inFilePath, outFilePath, params: dict, seed, resultQueue: Queue):
+# Worker process body: runs one take and reports (index, status, stats or error message) on resultQueue.
+
+    try:
+        os.makedirs(os.path.dirname(outFilePath) or '.', exist_ok=True)
+        stats, _ = runPipeline(inFilePath, params['amplitude'], params['frequency'], params['verticalShift'], int(params['occlusionNumber']),
+                               params['occlusionDuration'], int(params['opticalSkipFactor']), outFilePath=outFilePath, seed=seed, useCache=False)
+        resultQueue.put((index, 'ok', {'avgError': float(stats['avgError']), 'stdError': float(stats['stdError'])}))
+    except Exception:
+        resultQueue.put((index, 'failed', traceback.format_exc().strip().splitlines()[-1]))
+    return
+
+def runBatch(patterns: list, outDir, params: dict, workers=None, timeout=None, seed=None, resume: bool = True, onResult=None):
+    # Purpose:
+    # Runs every take matched by patterns and returns one summary row (dict with SUMMARY_FIELDS) per take, largest take first.
+    # Parameters:
+    # patterns: directories and/or glob patterns of input TRC files.  outDir: fused TRCs and manifests go here, under the take's relative path.
+    # params: dict with sweep.SWEEP_PARAMETERS.  workers: takes run at the same time (None = one per core).
+    # timeout: seconds a take may run before it is terminated (None = no limit).  seed: random seed applied to every take.
+    # resume: skip takes already finished with the same params and seed.  onResult(row): called as every take finishes.
+
+    workers = workers or os.cpu_count() or 1
+    settings = dict(params, seed=seed)
+
+    rows = []
+    pending = []
+    for take, inFilePath in findTakes(patterns):
+        outFilePath = os.path.join(outDir, os.path.splitext(take)[0] + '.trc')
+        manifest = _readManifest(outFilePath) if resume else None
+        if (manifest is not None and manifest.get('status') == 'ok' and manifest.get('settings') == settings
+                and os.path.exists(outFilePath)):
+            row = dict(manifest['summary'], status='skipped')
+            rows.append(row)
+            if onResult is not None:
+                onResult(row)
+        else:
+            pending.append((len(rows), take, inFilePath, outFilePath))
+            rows.append(None)
+
+    resultQueue = Queue()
+    running = {}                # row index -> (process, start time, take, inFilePath, outFilePath)
+
+    def finish(index, status, payload):
+        process, startTime, take, inFilePath, outFilePath = running.pop(index)
+        row = {'take': take, 'outFilePath': outFilePath, 'status': status, 'avgError': None, 'stdError': None,
+               'seconds': round(time.perf_counter() - startTime, 3), 'error': None}
+        if status == 'ok':
+            row.update(payload)
+        else:
+            row['error'] = payload
+        _writeManifest(outFilePath, {'status': status, 'inFilePath': inFilePath, 'settings': settings, 'summary': row})
+        rows[index] = row
+        if onResult is not None:
+            onResult(row)
+
+    pending.reverse()           # pop() from the end hands out the largest take first
+    while pending or running:
+        while pending and len(running) < workers:
+            index, take, inFilePath, outFilePath = pending.pop()
+            process = Process(target=_runTake, name='take-%d' % index, args=(index, inFilePath, outFilePath, params, seed, resultQueue))
+            process.start()
+            running[index] = (process, time.perf_counter(), take, inFilePath, outFilePath)
+
+        try:
+            index, status, payload = resultQueue.get(timeout=POLL_INTERVAL)
+            if index in running:
+                process = running[index][0]
+                finish(index, status, payload)
+                process.join()
+        except queue.Empty:
+            pass
+
+        now = time.perf_counter()
+        for index, (process, startTime, take, inFilePath, outFilePath) in list(running.items()):
+            if timeout is not None and now - startTime > timeout:
+                process.terminate()
+                process.join()
+                finish(index, 'timeout', 'no result after %s s' % timeout)
+            elif not process.is_alive() and process.exitcode != 0:     # died without reporting (killed, out of memory, ...)
+                finish(index, 'crashed', 'worker exited with code %s' % process.exitcode)
+
+    return rows
+
+def writeSummary(rows: list, outFilePath):
+# Writes the summary table. A .parquet path writes Parquet (needs pandas with pyarrow or fastparquet), anything else CSV.
+
+    if outFilePath.endswith('.parquet'):
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError('writing a Parquet summary needs pandas (and pyarrow or fastparquet), use a .csv path instead')
+        pandas.DataFrame(rows, columns=SUMMARY_FIELDS).to_parquet(outFilePath, index=False)
+        return
+
+    with open(outFilePath, 'w', newline='') as outputFile:
+        writer = csv.DictWriter(outputFile, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return
+
+if __name__ == '__main__':
+    freeze_support()
+
+    parser = argparse.ArgumentParser(description='Run the drift simulation over every take of a capture library and collect the optical comparison stats.')
+    parser.add_argument('inputs', nargs='+', help='directories (searched recursively for .trc files) and/or glob patterns')
+    parser.add_argument('--outDir', default='batch_output', help='folder for the fused TRC files and their manifests')
+    parser.add_argument('--summary', default='batch_summary.csv', help='summary table, .csv or .parquet')
+    addParameterArguments(parser)
+    parser.add_argument('--workers', type=int, default=None, help='takes processed at the same time (default: one per core)')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds before a take is abandoned')
+    parser.add_argument('--seed', type=int, default=None, help='seed applied to every take')
+    parser.add_argument('--rerun', action='store_true', help='process every take again, even if it already has an output and manifest')
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name in SWEEP_PARAMETERS}
+    try:
+        rows = runBatch(args.inputs, args.outDir, params, workers=args.workers, timeout=args.timeout, seed=args.seed,
+                        resume=not args.rerun, onResult=lambda row: print(row['status'], row['take'], row['avgError'], row['stdError']))
+    except ValueError as error:         # clashing takes, found before anything runs
+        parser.error(str(error))
+    writeSummary(rows, args.summary)
+
+    failures = [row for row in rows if row['status'] not in ('ok', 'skipped')]
+    print('%d takes, %d failed' % (len(rows), len(failures)))
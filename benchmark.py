@@ -0,0 +1,222 @@
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import freeze_support, get_context
+
+import numpy as np
+
+from pipeline import runPipeline
+from profiling import Profiler, peakRSS
+from sweep import PARAMETER_DEFAULTS
+from trcio import BLOCK_FRAMES, _saveAtomically, loadTRCCached, readTRC, writeTRCBlock
+
+
+# Benchmark harness: generates synthetic TRC captures at several scales, times every stage and the end-to-end batch
+# pipeline on them, and compares the results with a stored baseline.
+# Every scale runs in a fresh (spawned) process, so its peak RSS is its own and not left over from a larger scale.
+# Timings are the best of a few repeats. A stage regresses when it is slower than its baseline by more than the time
+# threshold, a scale when its peak RSS grows by more than the memory threshold.
+
+DEFAULT_MARKERS = 50
+DEFAULT_FRAMES = [10000, 100000, 1000000]
+DEFAULT_DATA_RATE = 120.0
+DEFAULT_DATA_DIR = '.benchmark_data'
+TIME_THRESHOLD = 0.25       # allowed slowdown against the baseline, as a fraction
+MEMORY_THRESHOLD = 0.25     # allowed peak RSS growth against the baseline, as a fraction
+MIN_BASELINE_SECONDS = 0.005  # stages faster than this in the baseline are too noisy to flag
+
+
+def syntheticHeaderLines(numMarkers: int, numFrames: int, dataRate: float):
+# The 6 header lines of a TRC file with markers M1..M<numMarkers>.
+
+    names = ['M%d' % (marker + 1) for marker in range(numMarkers)]
+    return [
+        'PathFileType\t4\t(X/Y/Z)\tsynthetic.trc\n',
+        'DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n',
+        '%g\t%g\t%d\t%d\tmm\t%g\t1\t%d\n' % (dataRate, dataRate, numFrames, numMarkers, dataRate, numFrames),
+        'Frame#\tTime\t' + '\t\t\t'.join(names) + '\t\t\n',
+        '\t\t' + '\t'.join('X%d\tY%d\tZ%d' % (marker, marker, marker) for marker in range(1, numMarkers + 1)) + '\n',
+        '\n',
+    ]
+
+def writeSyntheticTRC(filePath, numMarkers: int = DEFAULT_MARKERS, numFrames: int = DEFAULT_FRAMES[0], dataRate: float = DEFAULT_DATA_RATE,
+                      seed: int = 0):
+# Writes a synthetic capture: every marker moves smoothly around its own centre (a sine per axis with a random amplitude,
+# frequency and phase, like a limb swinging) with a little measurement noise. Frames are generated and written one block
+# at a time, so even a million frame file needs little memory. The file only appears once it is complete.
+
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(-1000, 1000, (numMarkers, 3))
+    amplitudes = rng.uniform(10, 300, (numMarkers, 3))
+    frequencies = rng.uniform(0.1, 2.0, (numMarkers, 3))
+    phases = rng.uniform(0, 2 * np.pi, (numMarkers, 3))
+
+    def write(binaryFile):
+        with io.TextIOWrapper(binaryFile, encoding='ascii', newline='') as outputFile:
+            outputFile.writelines(syntheticHeaderLines(numMarkers, numFrames, dataRate))
+            for start in range(0, numFrames, BLOCK_FRAMES):
+                frameIndexes = np.arange(start, min(start + BLOCK_FRAMES, numFrames))
+                times = frameIndexes / dataRate
+                readings = centres + amplitudes * np.sin(2 * np.pi * frequencies * times[:, None, None] + phases)
+                readings += rng.normal(0, 0.5, readings.shape)
+                writeTRCBlock(outputFile, start + 1, np.round(times, 5), readings)
+
+    _saveAtomically(filePath, write)
+    return
+
+def syntheticCapture(dataDir, numMarkers: int, numFrames: int, dataRate: float = DEFAULT_DATA_RATE, seed: int = 0):
+# Path of the synthetic capture for these settings, generated on first use.
+
+    filePath = os.path.join(dataDir, 'synthetic-%dx%d-%g-%d.trc' % (numMarkers, numFrames, dataRate, seed))
+    if not os.path.exists(filePath):
+        os.makedirs(dataDir, exist_ok=True)
+        writeSyntheticTRC(filePath, numMarkers, numFrames, dataRate, seed)
+    return filePath
+
+def benchmarkParameters(numMarkers: int):
+# Simulation parameters of the benchmark runs on a capture of numMarkers markers: the defaults (sweep.PARAMETER_DEFAULTS),
+# with at most half of the markers occluded at a time.
+
+    parameters = dict(PARAMETER_DEFAULTS)
+    parameters['occlusionNumber'] = min(parameters['occlusionNumber'], numMarkers // 2)
+    return parameters
+
+def _bestOf(repeat: int, function):
+# Runs function repeat times, returns the shortest wall time.
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchmarkScale(inFilePath, numFrames: int, numMarkers: int, repeat: int = 3):
+# Times one capture, meant to run in its own process. Returns {'stages': {stage: {'seconds', 'fps'}}, 'peakRSS': bytes}.
+# Stages: parse (text to arrays), cachedLoad (memory-mapped binary cache), the load/occluder/drifter/writer/stats stages
+# of runPipeline, and endToEnd (the whole runPipeline call, output written).
+
+    outFilePath = os.path.splitext(inFilePath)[0] + '.out.%d.trc' % os.getpid()
+    parameters = benchmarkParameters(numMarkers)
+    seconds = {'parse': _bestOf(repeat, lambda: readTRC(inFilePath))}
+
+    loadTRCCached(inFilePath)                  # build the cache outside the timing
+    seconds['cachedLoad'] = _bestOf(repeat, lambda: loadTRCCached(inFilePath))
+
+    try:
+        for _ in range(repeat):
+            profiler = Profiler()
+            start = time.perf_counter()
+            runPipeline(inFilePath, outFilePath=outFilePath, seed=0, profiler=profiler, **parameters)
+            endToEnd = time.perf_counter() - start
+
+            stageSeconds = {name: stage['wallSeconds'] for name, stage in profiler.summary()['stages'].items()}
+            stageSeconds['endToEnd'] = endToEnd
+            for name, value in stageSeconds.items():
+                seconds[name] = min(seconds.get(name, float('inf')), value)
+    finally:
+        if os.path.exists(outFilePath):
+            os.remove(outFilePath)
+
+    stages = {name: {'seconds': value, 'fps': numFrames / value if value > 0 else None} for name, value in seconds.items()}
+    return {'stages': stages, 'peakRSS': peakRSS()}
+
+def runBenchmarks(frameCounts: list = DEFAULT_FRAMES, numMarkers: int = DEFAULT_MARKERS, dataRate: float = DEFAULT_DATA_RATE,
+                  dataDir=DEFAULT_DATA_DIR, repeat: int = 3):
+    # Purpose:
+    # Benchmarks every scale and returns {'machine': ..., 'scales': {'<markers>x<frames>': benchmarkScale() result}}.
+    # Parameters:
+    # frameCounts: one scale per entry.  numMarkers, dataRate: of the synthetic captures.
+    # dataDir: where the synthetic captures are generated and kept between runs.  repeat: timings are the best of this many runs.
+
+    results = {'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'python': platform.python_version(),
+                           'numpy': np.__version__, 'cpus': os.cpu_count()},
+               'scales': {}}
+
+    for numFrames in frameCounts:
+        inFilePath = syntheticCapture(dataDir, numMarkers, numFrames, dataRate)
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            results['scales']['%dx%d' % (numMarkers, numFrames)] = executor.submit(benchmarkScale, inFilePath, numFrames, numMarkers, repeat).result()
+
+    return results
+
+def compareToBaseline(results: dict, baseline: dict, timeThreshold: float = TIME_THRESHOLD, memoryThreshold: float = MEMORY_THRESHOLD):
+# Compares results with a baseline from an earlier runBenchmarks. Returns a list of rows
+# (scale, metric, baseline, current, ratio, regressed) for every metric found in both.
+
+    rows = []
+    for scale, current in results['scales'].items():
+        reference = baseline.get('scales', {}).get(scale)
+        if reference is None:
+            continue
+
+        for name, stage in current['stages'].items():
+            if name not in reference['stages']:
+                continue
+            baseSeconds = reference['stages'][name]['seconds']
+            ratio = stage['seconds'] / baseSeconds if baseSeconds > 0 else float('inf')
+            regressed = baseSeconds >= MIN_BASELINE_SECONDS and ratio > 1 + timeThreshold
+            rows.append((scale, name + ' seconds', baseSeconds, stage['seconds'], ratio, regressed))
+
+        if current['peakRSS'] and reference.get('peakRSS'):
+            ratio = current['peakRSS'] / reference['peakRSS']
+            rows.append((scale, 'peakRSS', reference['peakRSS'], current['peakRSS'], ratio, ratio > 1 + memoryThreshold))
+
+    return rows
+
+def printResults(results: dict):
+
+    for scale, result in results['scales'].items():
+        print('%s  peak RSS %.1f MB' % (scale, (result['peakRSS'] or 0) / 1e6))
+        for name, stage in result['stages'].items():
+            fps = '%12.0f frames/s' % stage['fps'] if stage['fps'] else ''
+            print('    %-12s %10.4f s %s' % (name, stage['seconds'], fps))
+    return
+
+if __name__ == '__main__':
+    freeze_support()
+
+    parser = argparse.ArgumentParser(description='Benchmark the simulation stages on synthetic TRC captures and check for regressions.')
+    parser.add_argument('--frames', type=int, nargs='+', default=DEFAULT_FRAMES, help='frames per capture, one scale each')
+    parser.add_argument('--markers', type=int, default=DEFAULT_MARKERS)
+    parser.add_argument('--dataRate', type=float, default=DEFAULT_DATA_RATE)
+    parser.add_argument('--dataDir', default=DEFAULT_DATA_DIR, help='folder for the generated captures')
+    parser.add_argument('--repeat', type=int, default=3, help='timings are the best of this many runs')
+    parser.add_argument('--out', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='baseline JSON to compare against (exit code 1 on a regression)')
+    parser.add_argument('--saveBaseline', action='store_true', help='write the results to --baseline instead of comparing')
+    parser.add_argument('--timeThreshold', type=float, default=TIME_THRESHOLD, help='allowed slowdown, 0.25 = 25%%')
+    parser.add_argument('--memoryThreshold', type=float, default=MEMORY_THRESHOLD, help='allowed peak RSS growth, 0.25 = 25%%')
+    args = parser.parse_args()
+    if args.markers < 1:
+        parser.error('--markers must be at least 1')
+
+    results = runBenchmarks(args.frames, args.markers, args.dataRate, args.dataDir, args.repeat)
+    printResults(results)
+
+    if args.out:
+        with open(args.out, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+
+    if args.baseline and args.saveBaseline:
+        with open(args.baseline, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+        print('baseline written to', args.baseline)
+    elif args.baseline:
+        with open(args.baseline, 'r') as baselineFile:
+            baseline = json.load(baselineFile)
+
+        rows = compareToBaseline(results, baseline, args.timeThreshold, args.memoryThreshold)
+        for scale, metric, baseValue, value, ratio, regressed in rows:
+            print('%-12s %-20s %12.6g -> %12.6g  x%.2f %s' % (scale, metric, baseValue, value, ratio, 'REGRESSION' if regressed else ''))
+
+        regressions = [row for row in rows if row[5]]
+        if regressions:
+            print('%d regressions' % len(regressions))
+            sys.exit(1)
+        print('no regressions')
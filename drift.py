@@ -0,0 +1,149 @@
+import numpy as np
+
+
+# Drift models for the batch engine. Every model turns the time vector into a drift table, computed once per time step
+# and broadcast over the markers it applies to:
+# table(times, numMarkers) -> shape (frames, 1, 3) when every marker shares the drift, (frames, markers, 3) for per-marker models.
+# axes: the axes (0 = x, 1 = y, 2 = z) a model drifts, only those get rounded by engine.applyDriftTable.
+# Stochastic models keep their state between calls, so tables for consecutive time windows continue the same realization.
+
+AXIS_INDEXES = {'x': 0, 'y': 1, 'z': 2}
+
+
+def _axisIndexes(axes):
+# Accepts 'xz', ['x', 'z'] or (0, 2).
+
+    return tuple(sorted(AXIS_INDEXES[axis] if isinstance(axis, str) else int(axis) for axis in axes))
+
+class DriftModel:
+    # Base class. Subclasses implement table().
+
+    axes = (0,)
+    perMarker = False
+
+    def table(self, times: np.ndarray, numMarkers: int):
+        raise NotImplementedError
+
+    def _placeOnAxes(self, values: np.ndarray):
+    # values: shape (frames, markers or 1, number of axes) -> (frames, markers or 1, 3), zeros on the other axes.
+
+        table = np.zeros(values.shape[:2] + (3,))
+        table[:, :, list(self.axes)] = values
+        return table
+
+    def _width(self, numMarkers: int):
+        return numMarkers if self.perMarker else 1
+
+class SineDrift(DriftModel):
+    # The original drift: amplitude * sin(2 pi frequency t) + verticalShift, by default on the x axis only.
+    # engine.batchFuser stays the reference path: it adds sine and shift separately like addDriftToReading(), this table adds
+    # them first, which can move the 4th decimal of a reading sitting on a rounding tie.
+
+    def __init__(self, amplitude: float, frequency: float, verticalShift: float = 0.0, axes='x'):
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.verticalShift = verticalShift
+        self.axes = _axisIndexes(axes)
+
+    def table(self, times: np.ndarray, numMarkers: int):
+        drift = self.amplitude * np.sin(2 * np.pi * self.frequency * times) + self.verticalShift
+        return self._placeOnAxes(np.repeat(drift[:, None, None], len(self.axes), axis=2))
+
+class RandomWalkDrift(DriftModel):
+    # Random walk: independent Gaussian steps with standard deviation sigma * sqrt(dt), so the spread grows as sigma * sqrt(t).
+    # sigma: units per sqrt(second).  perMarker: an independent walk per marker instead of one shared walk.
+
+    def __init__(self, sigma: float, axes='xyz', perMarker: bool = False, seed=None):
+        self.sigma = sigma
+        self.axes = _axisIndexes(axes)
+        self.perMarker = perMarker
+        self.rng = np.random.default_rng(seed)
+        self._position = None
+        self._lastTime = None
+
+    def table(self, times: np.ndarray, numMarkers: int):
+        width = self._width(numMarkers)
+        if self._position is None:
+            self._position = np.zeros((width, len(self.axes)))
+            self._lastTime = times[0] if len(times) else 0.0
+
+        steps = np.diff(times, prepend=self._lastTime)
+        walk = self.rng.standard_normal((len(times), width, len(self.axes))) * (self.sigma * np.sqrt(steps))[:, None, None]
+        walk = np.cumsum(np.concatenate([self._position[None], walk]), axis=0)[1:]   # summed on from the last position, so split windows give the same walk
+
+        if len(times):
+            self._position = walk[-1]
+            self._lastTime = times[-1]
+        return self._placeOnAxes(walk)
+
+class BiasInstabilityDrift(DriftModel):
+    # Bias instability as a first order Gauss-Markov process: a bias that wanders around 0 with standard deviation sigma
+    # and correlation time correlationTime (seconds). b[n] = phi * b[n-1] + sigma * sqrt(1 - phi^2) * w[n], phi = exp(-dt / correlationTime).
+    # The recursion is solved in blocks with cumulative sums, so it stays vectorized without the powers of phi overflowing.
+
+    _BLOCK_DECAY = 10.0     # each block spans at most this many correlation times
+
+    def __init__(self, sigma: float, correlationTime: float, axes='xyz', perMarker: bool = False, seed=None):
+        self.sigma = sigma
+        self.correlationTime = correlationTime
+        self.axes = _axisIndexes(axes)
+        self.perMarker = perMarker
+        self.rng = np.random.default_rng(seed)
+        self._bias = None
+        self._lastTime = None
+
+    def table(self, times: np.ndarray, numMarkers: int):
+        width = self._width(numMarkers)
+        numFrames = len(times)
+        if self._bias is None:
+            self._bias = self.sigma * self.rng.standard_normal((width, len(self.axes)))   # start in the stationary distribution
+            self._lastTime = times[0] if numFrames else 0.0
+
+        steps = np.diff(times, prepend=self._lastTime)
+        decay = steps / self.correlationTime                     # -log(phi) per frame
+        noise = self.rng.standard_normal((numFrames, width, len(self.axes))) * (self.sigma * np.sqrt(-np.expm1(-2 * decay)))[:, None, None]
+
+        totalDecay = np.cumsum(decay)
+        bias = np.empty((numFrames, width, len(self.axes)))
+        start = 0
+        while start < numFrames:
+            blockBase = totalDecay[start - 1] if start > 0 else 0.0
+            stop = max(start + 1, int(np.searchsorted(totalDecay, blockBase + self._BLOCK_DECAY, side='right')))
+            cumulativeDecay = (totalDecay[start:stop] - blockBase)[:, None, None]
+            # b[j] = phi^(1..j) * (b0 + sum_i phi^-(1..i) n[i])
+            bias[start:stop] = np.exp(-cumulativeDecay) * (self._bias + np.cumsum(np.exp(cumulativeDecay) * noise[start:stop], axis=0))
+            self._bias = bias[stop - 1]
+            start = stop
+
+        if numFrames:
+            self._lastTime = times[-1]
+        return self._placeOnAxes(bias)
+
+class PerAxisDrift(DriftModel):
+    # A separate model per axis, e.g. PerAxisDrift(x=SineDrift(...), z=RandomWalkDrift(...)). Each model only drives the axis it
+    # is given for: its first driven axis is moved there, whatever its own axes setting was.
+
+    def __init__(self, x: DriftModel = None, y: DriftModel = None, z: DriftModel = None):
+        self.models = {axis: model for axis, model in ((0, x), (1, y), (2, z)) if model is not None}
+        self.axes = tuple(self.models.keys())
+        self.perMarker = any(model.perMarker for model in self.models.values())
+
+    def table(self, times: np.ndarray, numMarkers: int):
+        table = np.zeros((len(times), self._width(numMarkers), 3))
+        for axis, model in self.models.items():
+            table[:, :, axis] += model.table(times, numMarkers)[:, :, model.axes[0]]
+        return table
+
+class CombinedDrift(DriftModel):
+    # Sum of several models, e.g. the sine drift plus a random walk.
+
+    def __init__(self, *models: DriftModel):
+        self.models = models
+        self.axes = tuple(sorted(set(axis for model in models for axis in model.axes)))
+        self.perMarker = any(model.perMarker for model in models)
+
+    def table(self, times: np.ndarray, numMarkers: int):
+        table = np.zeros((len(times), self._width(numMarkers), 3))
+        for model in self.models:
+            table += model.table(times, numMarkers)
+        return table
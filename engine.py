@@ -0,0 +1,297 @@
+from trc import TRCData
+import random
+
+import numpy as np
+
+from profiling import NO_PROFILER, Profiler
+
+# Batch version of the feeder -> fuser (occluder + drifter) -> writer pipeline in simulation.py.
+# Instead of walking one frame at a time, the whole capture is held as arrays:
+# times:    shape (frames,)             time value of every frame
+# readings: shape (frames, markers, 3)  x, y and z reading of every marker at every frame
+# mask:     shape (frames, markers)     True where the fused output uses a drifted inertial reading
+# For the same random seed the fused output matches the per-frame fuser.
+
+
+def trcToArrays(data: TRCData):
+# Converts a loaded TRCData object into the time vector and reading array used by the batch engine.
+# Frames are read in the same order as feederFunc sends them: [1] is frame 1.
+
+    frameNumbers = range(1, int(data['NumFrames']) + 1)
+    times = np.array([data[frameNum][0] for frameNum in frameNumbers], dtype=np.float64)
+    readings = np.array([data[frameNum][1] for frameNum in frameNumbers], dtype=np.float64)
+
+    return times, readings
+
+def drawOcclusionGroup(numMarkers: int, occlusionNumber: int):
+# Picks occlusionNumber distinct marker indexes at random, consuming the global 'random' state exactly like occluder() always has.
+# In group mode numMarkers is the number of marker groups and the indexes are group indexes.
+
+    if occlusionNumber > numMarkers:
+        raise ValueError('occlusionNumber (%d) is larger than the number of occlusion units (%d)' % (occlusionNumber, numMarkers))
+
+    oclGroupIndexes = []
+    for _ in range( 0, occlusionNumber ):
+        random_num = random.randint(0, numMarkers - 1)
+        while random_num in oclGroupIndexes:
+            random_num = random.randint(0, numMarkers - 1)
+        oclGroupIndexes.append(random_num)
+
+    return oclGroupIndexes
+
+class OcclusionScheduler:
+    # Purpose:
+    # Explicit occlusion state in place of the per-marker counts occluder() scans every frame: the active group and how
+    # many optical frames it stays occluded for. Groups are drawn with Generator.choice(replace=False) (Floyd's algorithm
+    # for any realistic marker count), so the cost per group only depends on the size of the group, not on the number
+    # of markers.
+    # Parameters:
+    # numMarkers: occlusion units to draw from, the markers, or the marker groups in group mode.
+    # oclFrameTarget: optical frames per group (int(opticalFPS * occlusionDuration)). 0 or less keeps the first group
+    #                 forever, like occluder().  seed: anything np.random.default_rng accepts (int, SeedSequence, Generator).
+
+    def __init__(self, numMarkers: int, occlusionNumber: int, oclFrameTarget: int, seed=None):
+
+        if occlusionNumber > numMarkers:
+            raise ValueError('occlusionNumber (%d) is larger than the number of occlusion units (%d)' % (occlusionNumber, numMarkers))
+
+        self.numMarkers = numMarkers
+        self.occlusionNumber = occlusionNumber
+        self.oclFrameTarget = oclFrameTarget
+        self.rng = np.random.default_rng(seed)
+        self.activeGroup = np.empty(0, dtype=np.intp)
+        self.framesRemaining = 0            # optical frames left for the active group, -1 = never ends
+
+    def _drawGroups(self, numGroups: int):
+    # The next numGroups groups, shape (numGroups, occlusionNumber). Rows are drawn in order, so drawing the groups
+    # one at a time or all at once gives the same groups.
+
+        groups = [self.rng.choice(self.numMarkers, size=self.occlusionNumber, replace=False) for _ in range(numGroups)]
+        return np.array(groups, dtype=np.intp).reshape(numGroups, self.occlusionNumber)
+
+    def next(self):
+    # Occluded marker indexes for the next optical frame.
+
+        if self.framesRemaining == 0:
+            self.activeGroup = self._drawGroups(1)[0]
+            self.framesRemaining = self.oclFrameTarget if self.oclFrameTarget > 0 else -1
+        if self.framesRemaining > 0:
+            self.framesRemaining -= 1
+        return self.activeGroup
+
+    def advance(self, numOpticalFrames: int):
+    # Occluded marker indexes for each of the next numOpticalFrames optical frames, shape (numOpticalFrames, occlusionNumber).
+    # Same result as calling next() that many times.
+
+        groups = [np.empty((0, self.occlusionNumber), dtype=np.intp)]
+        repeats = []
+        framesLeft = numOpticalFrames
+
+        if framesLeft > 0 and self.framesRemaining != 0:       # the active group continues
+            take = framesLeft if self.framesRemaining < 0 else min(framesLeft, self.framesRemaining)
+            groups.append(self.activeGroup[None, :])
+            repeats.append(take)
+            if self.framesRemaining > 0:
+                self.framesRemaining -= take
+            framesLeft -= take
+
+        if framesLeft > 0:
+            groupLength = self.oclFrameTarget if self.oclFrameTarget > 0 else framesLeft
+            numGroups = -(-framesLeft // groupLength)
+            newGroups = self._drawGroups(numGroups)
+            groups.append(newGroups)
+            repeats.extend([groupLength] * (numGroups - 1) + [framesLeft - groupLength * (numGroups - 1)])
+            self.activeGroup = newGroups[-1]
+            self.framesRemaining = groupLength - repeats[-1] if self.oclFrameTarget > 0 else -1
+
+        return np.repeat(np.concatenate(groups).astype(np.intp, copy=False), repeats, axis=0)
+
+class GlobalRandomScheduler(OcclusionScheduler):
+    # OcclusionScheduler drawing its groups from the global 'random' state with drawOcclusionGroup(), i.e. the same groups
+    # occluder() picks for the same random.seed(). Keeps the legacy groups going across windows of a capture.
+
+    def __init__(self, numMarkers: int, occlusionNumber: int, oclFrameTarget: int):
+        super().__init__(numMarkers, occlusionNumber, oclFrameTarget)
+
+    def _drawGroups(self, numGroups: int):
+        groups = [drawOcclusionGroup(self.numMarkers, self.occlusionNumber) for _ in range(numGroups)]
+        return np.array(groups, dtype=np.intp).reshape(numGroups, self.occlusionNumber)
+
+def buildOcclusionMask(numFrames: int, numMarkers: int, opticalFPS: float, occlusionDuration: float, occlusionNumber: int, opticalSkipFactor: int,
+                       scheduler: OcclusionScheduler = None, firstFrame: int = 0, markerGroups = None):
+    # Purpose:
+    # Builds the (frames, markers) boolean mask of readings that must be filled in by the drifter.
+    # Parameters:
+    # opticalFPS, occlusionDuration, occlusionNumber: same meaning as in occluder().
+    # opticalSkipFactor: every opticalSkipFactor-th frame (starting at frame 0) carries an optical reading.
+    # scheduler: draw the groups from this OcclusionScheduler (seeded numpy stream, state carries over between calls).
+    #            None draws them from the global 'random' state exactly like occluder(), for output identical to the fuser.
+    # firstFrame: index of the first frame in the whole capture, when building the mask of one window of it. Keeps the
+    #             optical frames on every opticalSkipFactor-th frame of the capture. Windows after the first need the
+    #             scheduler of the previous window (a GlobalRandomScheduler for the global 'random' groups).
+    # markerGroups: a markergroups.MarkerGroups. Occludes whole groups: occlusionNumber counts groups, the scheduler draws
+    #               group indexes (its numMarkers is the number of groups) and every marker of a drawn group is occluded.
+
+    #PROGRAM LOGIC:
+    # inertial only frames: every marker is drifted.
+    # optical frames: a random group is occluded for oclFrameTarget optical frames, then a new group is seeded.
+    # if oclFrameTarget is 0 occluder() never reaches its target, so the first group stays occluded for the whole run.
+
+    mask = np.ones((numFrames, numMarkers), dtype=bool)
+    opticalFrames = np.arange((-firstFrame) % opticalSkipFactor, numFrames, opticalSkipFactor)
+    mask[opticalFrames] = False
+
+    numOptical = len(opticalFrames)
+    if occlusionNumber == 0 or numOptical == 0:
+        return mask
+
+    if scheduler is None:
+        numUnits = numMarkers if markerGroups is None else len(markerGroups)
+        scheduler = GlobalRandomScheduler(numUnits, occlusionNumber, int(opticalFPS * occlusionDuration))  # same truncation as occluder()
+
+    if markerGroups is None:
+        mask[opticalFrames[:, None], scheduler.advance(numOptical)] = True
+    else:
+        mask[opticalFrames] = markerGroups.occludedMarkers(scheduler.advance(numOptical))
+
+    return mask
+
+def exactRound(values: np.ndarray, ndigits: int):
+# Vectorized round(value, ndigits) that gives exactly what Python's round() gives.
+# np.round scales by 10**ndigits first and the rounding error of that product can flip values that sit on a tie
+# (common in the error values: TRC files store 5 decimals and drifted readings are rounded to 4), so the error of
+# the product is recovered exactly (Dekker two-product) and used to settle the ties.
+
+    values = np.asarray(values, dtype=np.float64)
+    scale = 10.0 ** ndigits
+    scaled = values * scale
+
+    splitter = 134217729.0  # 2**27 + 1
+    valuesHigh = values * splitter
+    valuesHigh = valuesHigh - (valuesHigh - values)
+    valuesLow = values - valuesHigh
+    scaleHigh = scale * splitter
+    scaleHigh = scaleHigh - (scaleHigh - scale)
+    scaleLow = scale - scaleHigh
+    productError = ((valuesHigh * scaleHigh - scaled) + valuesHigh * scaleLow + valuesLow * scaleHigh) + valuesLow * scaleLow
+
+    nearest = np.rint(scaled)
+    fraction = scaled - nearest
+    nearest += (fraction == 0.5) & (productError > 0)
+    nearest -= (fraction == -0.5) & (productError < 0)
+
+    return nearest / scale
+
+def consecutiveInertialCounts(mask: np.ndarray, initialCounts: np.ndarray = None):
+# Per-marker consecutive inertial frame count (slot [1] of the markers tuples), for a whole window at once: how many frames
+# in a row, up to and including each frame, a marker has been filled in by the drifter. Visible optical frames reset it to 0.
+# initialCounts: counts carried in from before the window (shape (markers,)), added until each marker's first reset.
+
+    drifted = np.cumsum(mask, axis=0, dtype=np.int64)
+    atLastFix = np.maximum.accumulate(np.where(mask, 0, drifted), axis=0)
+    counts = drifted - atLastFix
+
+    if initialCounts is not None:
+        counts += np.where(np.logical_or.accumulate(~mask, axis=0), 0, initialCounts)
+
+    return counts
+
+def finalInertialCounts(mask: np.ndarray, initialCounts: np.ndarray = None):
+# Last row of consecutiveInertialCounts(mask, initialCounts), without building the whole counts array: the counts to carry
+# into the next window.
+
+    numFrames = mask.shape[0]
+    visible = ~mask
+    framesSinceFix = np.argmax(visible[::-1], axis=0)        # frames after each marker's last visible frame
+    neverVisible = numFrames + (initialCounts if initialCounts is not None else 0)
+    return np.where(visible.any(axis=0), framesSinceFix, neverVisible)
+
+def accumulatedDrift(counts: np.ndarray, dataRate: float, amplitude: float, frequency: float, verticalShift: float):
+# Long term drift after counts consecutive inertial frames: the sine drift read as a drift rate (units per second,
+# amplitude * sin(2 pi frequency t) + verticalShift) and integrated over the time since the last optical fix, in closed form:
+# amplitude * (1 - cos(2 pi frequency t)) / (2 pi frequency) + verticalShift * t,  t = counts / dataRate.
+# Starts near 0 on the first drifted frame and grows by verticalShift per second (monotonically when verticalShift >= |amplitude|).
+# A function of the integer counts only, so windows of a capture that carry the counts over give the same drift.
+
+    elapsed = counts / dataRate
+    if frequency == 0:
+        return verticalShift * elapsed
+    angularFrequency = 2 * np.pi * frequency
+    return amplitude * (1 - np.cos(angularFrequency * elapsed)) / angularFrequency + verticalShift * elapsed
+
+def batchFuser(times: np.ndarray, readings: np.ndarray, mask: np.ndarray, amplitude: float, frequency: float, verticalShift: float):
+# Array equivalent of drifter() applied to every frame: drift is only added to the x axis, rounded like addDriftToReading().
+# times: shape (frames,), or (frames, markers) for a separate drift time per marker.
+
+    sine = amplitude * np.sin(2 * np.pi * frequency * times)
+    if sine.ndim == 1:
+        sine = sine[:, None]
+    driftedX = np.round(readings[:, :, 0] + sine + verticalShift, 4)  # the sum is a numpy float in addDriftToReading(), so round() there is np.round
+
+    fused = readings.copy()
+    fused[:, :, 0] = np.where(mask, driftedX, readings[:, :, 0])
+
+    return fused
+
+def batchFuserInPlace(times: np.ndarray, readings: np.ndarray, valid: np.ndarray, amplitude: float, frequency: float, verticalShift: float):
+# batchFuser() that overwrites readings instead of returning a copy, for the streaming fuser's chunk buffers.
+# valid: validity mask, True where a reading came from the optical system. Every other reading gets the drifted x.
+
+    sine = amplitude * np.sin(2 * np.pi * frequency * times)
+    x = readings[:, :, 0]
+    np.copyto(x, np.round(x + sine[:, None] + verticalShift, 4), where=~valid)
+    return readings
+
+def applyDriftTable(readings: np.ndarray, mask: np.ndarray, table: np.ndarray, axes: tuple):
+# Drift model version of batchFuser(): adds a drift table (see drift.py) to the masked readings on the given axes,
+# rounded like addDriftToReading(). Axes the model does not drive are copied through untouched.
+
+    axes = list(axes)
+    drifted = np.round(readings[:, :, axes] + table[:, :, axes], 4)
+
+    fused = readings.copy()
+    fused[:, :, axes] = np.where(mask[:, :, None], drifted, readings[:, :, axes])
+
+    return fused
+
+def applyAccumulatedDrift(readings: np.ndarray, mask: np.ndarray, drift: np.ndarray):
+# Adds accumulatedDrift() (shape (frames, markers)) to the x of the masked readings, rounded like addDriftToReading().
+
+    fused = readings.copy()
+    fused[:, :, 0] = np.where(mask, np.round(readings[:, :, 0] + drift, 4), readings[:, :, 0])
+    return fused
+
+def runBatchSimulation(times: np.ndarray, readings: np.ndarray, dataRate: float, opticalSkipFactor: int, occlusionDuration: float, occlusionNumber: int,
+                       amplitude: float, frequency: float, verticalShift: float, scheduler: OcclusionScheduler = None, driftModel = None,
+                       accumulateDrift: bool = False, profiler: Profiler = NO_PROFILER, firstFrame: int = 0, initialCounts: np.ndarray = None,
+                       markerGroups = None):
+# Full batch pipeline for an already loaded capture (see trcio.readTRC or trcToArrays). Returns the fused readings and the occlusion mask.
+# scheduler: see buildOcclusionMask.  driftModel: a drift.DriftModel used in place of the amplitude/frequency/verticalShift sine.
+# accumulateDrift: long term drift (accumulatedDrift): drift builds up with each marker's time since its last optical fix
+#                  (consecutive inertial frames / dataRate) and starts over when the marker is seen again. Sine drift only,
+#                  raises ValueError with a driftModel.
+# profiler: times the 'occluder' (mask) and 'drifter' (fusing) stages.
+# firstFrame, initialCounts: for one window of a longer capture, see buildOcclusionMask and consecutiveInertialCounts.
+# markerGroups: occlude whole marker groups, see buildOcclusionMask.
+
+    if accumulateDrift and driftModel is not None:
+        raise ValueError('accumulateDrift integrates the sine drift, it cannot be combined with a driftModel')
+
+    numFrames, numMarkers = readings.shape[0], readings.shape[1]
+    opticalFPS = dataRate / opticalSkipFactor
+
+    with profiler.stage('occluder', numFrames):
+        mask = buildOcclusionMask(numFrames, numMarkers, opticalFPS, occlusionDuration, occlusionNumber, opticalSkipFactor, scheduler, firstFrame,
+                                  markerGroups)
+
+    with profiler.stage('drifter', numFrames):
+        if accumulateDrift:
+            drift = accumulatedDrift(consecutiveInertialCounts(mask, initialCounts), dataRate, amplitude, frequency, verticalShift)
+            fused = applyAccumulatedDrift(readings, mask, drift)
+        elif driftModel is not None:
+            fused = applyDriftTable(readings, mask, driftModel.table(times, numMarkers), driftModel.axes)
+        else:
+            fused = batchFuser(times, readings, mask, amplitude, frequency, verticalShift)
+
+    return fused, mask
+
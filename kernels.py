@@ -0,0 +1,144 @@
+import numpy as np
+
+from engine import accumulatedDrift
+from profiling import NO_PROFILER, Profiler
+
+try:
+    import numba
+except ImportError:         # optional: without numba the kernels run as plain (slow) Python, with the same results
+    numba = None
+
+
+# Compiled kernel backend for occlusion policies that carry state from group to group and do not vectorize well:
+# - noRepeat: a new group never contains a unit of the group before it (the commented out "old new occluder").
+# - groups: whole marker groups (body segments) are occluded instead of single markers (the old 'grouping' lists).
+# One loop walks the frames, occluding and drifting each in turn like the fuser, in numba's nopython mode over NumPy arrays.
+# Occlusion units: a unit is one marker, or one marker group. Groups are passed in CSR form (unitArrays): the members of
+# unit u are members[offsets[u]:offsets[u + 1]], so the kernel never looks at marker names.
+# Random draws: every group takes one row of uniforms (one per unit) generated up front with numpy, the occlusionNumber
+# allowed units with the smallest uniforms form the group. The kernel itself draws nothing, so the compiled and the
+# pure Python kernel give the same groups, and with one unit per marker and no noRepeat they are the groups a
+# montecarlo.TrialScheduler with the same seed picks.
+
+NUMBA_AVAILABLE = numba is not None
+
+
+def _kernel(function):
+# Compiles function in nopython mode when numba is installed, leaves it as plain Python otherwise.
+
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+@_kernel
+def _pickUnits(uniforms, blocked, occlusionNumber, chosen):
+# Fills chosen with the occlusionNumber units not blocked that hold the smallest uniforms, smallest first.
+
+    taken = blocked.copy()
+    for slot in range(occlusionNumber):
+        best = -1
+        for unit in range(uniforms.shape[0]):
+            if not taken[unit] and (best < 0 or uniforms[unit] < uniforms[best]):
+                best = unit
+        chosen[slot] = best
+        taken[best] = True
+
+@_kernel
+def _occludeAndDrift(readings, sine, countDrift, uniforms, members, offsets, occlusionNumber, oclFrameTarget, opticalSkipFactor,
+                     noRepeat, accumulateDrift, verticalShift, fused, mask):
+# The frame loop. Writes the drifted x readings into fused (a copy of readings) and the occlusion mask into mask.
+# sine: drift sine per frame.  countDrift: engine.accumulatedDrift per consecutive inertial frame count, used with accumulateDrift.
+
+    numFrames, numMarkers = readings.shape[0], readings.shape[1]
+    numUnits = offsets.shape[0] - 1
+    activeUnits = np.zeros(occlusionNumber, dtype=np.int64)
+    blocked = np.zeros(numUnits, dtype=np.bool_)
+    occluded = np.zeros(numMarkers, dtype=np.bool_)
+    counts = np.zeros(numMarkers, dtype=np.int64)
+    framesRemaining = 0             # optical frames left for the active group, -1 = never ends
+    groupsDrawn = 0
+
+    for frame in range(numFrames):
+        if frame % opticalSkipFactor == 0:          # optical frame: only the active group is occluded
+            if framesRemaining == 0 and occlusionNumber > 0:
+                blocked[:] = False
+                if noRepeat and groupsDrawn > 0:
+                    for slot in range(occlusionNumber):
+                        blocked[activeUnits[slot]] = True
+                _pickUnits(uniforms[groupsDrawn], blocked, occlusionNumber, activeUnits)
+                groupsDrawn += 1
+                framesRemaining = oclFrameTarget if oclFrameTarget > 0 else -1
+
+                occluded[:] = False
+                for slot in range(occlusionNumber):
+                    unit = activeUnits[slot]
+                    for member in range(offsets[unit], offsets[unit + 1]):
+                        occluded[members[member]] = True
+            if framesRemaining > 0:
+                framesRemaining -= 1
+            for marker in range(numMarkers):
+                mask[frame, marker] = occluded[marker]
+        else:                                       # inertial only frame: every marker is drifted
+            for marker in range(numMarkers):
+                mask[frame, marker] = True
+
+        for marker in range(numMarkers):
+            if mask[frame, marker]:
+                counts[marker] += 1
+                if accumulateDrift:
+                    drifted = readings[frame, marker, 0] + countDrift[counts[marker]]
+                else:
+                    drifted = readings[frame, marker, 0] + sine[frame] + verticalShift
+                fused[frame, marker, 0] = np.rint(drifted * 10000.0) / 10000.0   # np.round(drifted, 4)
+            else:
+                counts[marker] = 0
+
+def unitArrays(groups: list, numMarkers: int):
+# Occlusion units in the CSR form the kernel takes: (members, offsets), unit u is members[offsets[u]:offsets[u + 1]].
+# groups: list of marker index lists, one per unit, or None for one unit per marker.
+
+    if groups is None:
+        return np.arange(numMarkers, dtype=np.int64), np.arange(numMarkers + 1, dtype=np.int64)
+
+    members = [np.asarray(group, dtype=np.int64).ravel() for group in groups]
+    for group in members:
+        if group.size and (group.min() < 0 or group.max() >= numMarkers):
+            raise ValueError('marker group %s has indexes outside 0..%d' % (group.tolist(), numMarkers - 1))
+    offsets = np.zeros(len(members) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(group) for group in members])
+    return (np.concatenate(members) if members else np.empty(0, dtype=np.int64)), offsets
+
+def runKernelSimulation(times: np.ndarray, readings: np.ndarray, dataRate: float, opticalSkipFactor: int, occlusionDuration: float,
+                        occlusionNumber: int, amplitude: float, frequency: float, verticalShift: float, seed=None, groups: list = None,
+                        noRepeat: bool = False, accumulateDrift: bool = False, profiler: Profiler = NO_PROFILER):
+    # Purpose:
+    # engine.runBatchSimulation on the kernel backend. Returns the fused readings and the occlusion mask.
+    # Parameters:
+    # Same as engine.runBatchSimulation, with the sine drift.  seed: seeds the uniforms of the groups (anything np.random.default_rng accepts).
+    # groups: marker index lists occluded as a whole (see unitArrays), occlusionNumber then counts groups. None occludes single markers.
+    # noRepeat: a new group shares no unit with the one before it. Needs at least 2 * occlusionNumber units.
+    # profiler: times the whole loop as the 'kernel' stage.
+
+    numFrames, numMarkers = readings.shape[0], readings.shape[1]
+    members, offsets = unitArrays(groups, numMarkers)
+    numUnits = len(offsets) - 1
+    if occlusionNumber > numUnits:
+        raise ValueError('occlusionNumber (%d) is larger than the number of occlusion units (%d)' % (occlusionNumber, numUnits))
+
+    numOptical = -(-numFrames // opticalSkipFactor)
+    oclFrameTarget = int(dataRate / opticalSkipFactor * occlusionDuration)     # same truncation as occluder()
+    numGroups = (-(-numOptical // oclFrameTarget) if oclFrameTarget > 0 else 1) if occlusionNumber > 0 and numOptical > 0 else 0
+    if noRepeat and numGroups > 1 and 2 * occlusionNumber > numUnits:
+        raise ValueError('noRepeat needs at least %d occlusion units, there are %d' % (2 * occlusionNumber, numUnits))
+
+    uniforms = np.random.default_rng(seed).random((numGroups, numUnits))
+    sine = amplitude * np.sin(2 * np.pi * frequency * times)
+    countDrift = accumulatedDrift(np.arange(numFrames + 1), dataRate, amplitude, frequency, verticalShift) if accumulateDrift else sine[:0]
+
+    fused = np.array(readings, dtype=np.float64)
+    mask = np.empty((numFrames, numMarkers), dtype=bool)
+    with profiler.stage('kernel', numFrames):
+        _occludeAndDrift(np.ascontiguousarray(readings, dtype=np.float64), sine, countDrift, uniforms, members, offsets, occlusionNumber,
+                         oclFrameTarget, opticalSkipFactor, noRepeat, accumulateDrift, float(verticalShift), fused, mask)
+
+    return fused, mask
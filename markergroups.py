@@ -0,0 +1,59 @@
+import json
+
+import numpy as np
+
+
+# Marker groups (body segments) for group occlusion: instead of single markers, occlusionNumber whole segments are
+# occluded at a time, like the old occluder did with the 'grouping' lists.
+# A group definition file is a JSON object mapping each group name to the names of its markers, in any order:
+# {"head": ["TopHead", "LfFtHead", ...], "chest": [...], ...}   (marker_groups.json holds the old groups)
+# The names are resolved against the marker names of a capture once, up front. From then on a group is only an index
+# array and a row of a (groups, markers) membership mask, so occluding segments is one mask lookup per frame (or one per
+# window in the batch engine), never a name by name scan like removeReading().
+
+DEFAULT_GROUPS_FILE = 'marker_groups.json'
+
+
+def loadMarkerGroups(filePath):
+# Reads a group definition file. Returns {group name: [marker names]} in file order.
+
+    with open(filePath, 'r') as groupsFile:
+        groups = json.load(groupsFile)
+
+    if not isinstance(groups, dict) or not all(isinstance(names, list) for names in groups.values()):
+        raise ValueError('%s: a group definition file maps group names to lists of marker names' % filePath)
+    return groups
+
+class MarkerGroups:
+    # Purpose:
+    # Group definitions resolved against the marker order of one capture.
+    # Parameters:
+    # groups: {group name: [marker names]} (see loadMarkerGroups), or the path of a group definition file.
+    # markerNames: marker names in column order (header['Markers']).
+    # Attributes:
+    # names: group names.  indexes: one int array of marker indexes per group.
+    # membership: shape (groups, markers), True where the marker belongs to the group.
+
+    def __init__(self, groups, markerNames: list):
+
+        if not isinstance(groups, dict):
+            groups = loadMarkerGroups(groups)
+
+        markerIndexes = {name: index for index, name in enumerate(markerNames)}
+        unknown = sorted({name for names in groups.values() for name in names if name not in markerIndexes})
+        if unknown:
+            raise ValueError('marker groups name markers the capture does not have: %s' % ', '.join(unknown))
+
+        self.names = list(groups)
+        self.indexes = [np.array([markerIndexes[name] for name in groups[group]], dtype=np.intp) for group in self.names]
+        self.membership = np.zeros((len(self.names), len(markerNames)), dtype=bool)
+        for row, indexes in enumerate(self.indexes):
+            self.membership[row, indexes] = True
+
+    def __len__(self):
+        return len(self.names)
+
+    def occludedMarkers(self, groupIndexes: np.ndarray):
+    # Markers covered by the given groups: groupIndexes of shape (..., groups per frame) -> mask of shape (..., markers).
+
+        return self.membership[groupIndexes].any(axis=-2)
@@ -0,0 +1,193 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import freeze_support
+from statistics import NormalDist
+
+import numpy as np
+
+from engine import OcclusionScheduler, exactRound, runBatchSimulation
+from stats import opticalComparisonStats
+from sweep import SWEEP_PARAMETERS, addParameterArguments
+from trcio import loadTRCCached
+
+
+# Monte Carlo mode: one run is a single sample of the occlusion pattern, so the avg/std error are repeated over many trials
+# and reported as a mean with a confidence interval. Trial i always draws its groups from TrialScheduler(seed=child i)
+# of SeedSequence(seed).spawn(), so results do not depend on the batch size, the number of workers or early stopping.
+#
+# Vectorized pass: with the sine drift the error of a reading does not depend on the occlusion pattern, only on whether it
+# is occluded. The optical frame errors are computed once and summed per occlusion group span, then every trial only has
+# to add up the sums of the markers it occluded: a whole batch of trials is one gather over (trials, groups, markers per group).
+# Accumulated drift does depend on the pattern (and very large files may not fit the error tables in memory), those run
+# every trial through the full engine on a process pool instead.
+
+TRIAL_STATS = ['avgError', 'stdError']
+DEFAULT_MEMORY_LIMIT = 1 << 30      # bytes the vectorized pass may use, above this the process pool is used
+MIN_TRIALS = 10                     # trials run before early stopping is considered
+
+class TrialScheduler(OcclusionScheduler):
+    # OcclusionScheduler drawing a group as the occlusionNumber markers holding the smallest of a row of uniforms. Costs
+    # O(markers log markers) per group instead of O(occlusionNumber), but draws every group a trial needs in one call,
+    # which is what makes the vectorized pass cheap: a per group Generator.choice call dominates it otherwise.
+
+    def _drawGroups(self, numGroups: int):
+        return np.argsort(self.rng.random((numGroups, self.numMarkers)), axis=1)[:, :self.occlusionNumber]
+
+# worker side state, filled in once per worker process by _initWorker
+_workerCapture = None
+
+
+def _initWorker(inFilePath):
+# Loads the capture once per worker. The binary cache is memory-mapped, so all workers share its pages.
+
+    global _workerCapture
+    _workerCapture = loadTRCCached(inFilePath)
+
+def _runTrial(params: dict, seedSequence: np.random.SeedSequence):
+# One trial through the full engine (process pool path). Returns (avgError, stdError).
+
+    header, times, readings = _workerCapture
+    numMarkers = readings.shape[1]
+    opticalSkipFactor = int(params['opticalSkipFactor'])
+    oclFrameTarget = int(header['DataRate'] / opticalSkipFactor * params['occlusionDuration'])
+    scheduler = TrialScheduler(numMarkers, int(params['occlusionNumber']), oclFrameTarget, seedSequence)
+
+    fused, _ = runBatchSimulation(times, readings, header['DataRate'], opticalSkipFactor, params['occlusionDuration'], int(params['occlusionNumber']),
+                                  params['amplitude'], params['frequency'], params['verticalShift'], scheduler,
+                                  accumulateDrift=params.get('accumulateDrift', False))
+    avgError, standardDeviation = opticalComparisonStats(readings, fused, opticalSkipFactor)
+    return float(avgError), float(standardDeviation)
+
+class _GroupSums:
+    # Per occlusion group span sums of the optical frame errors, for the vectorized pass.
+
+    def __init__(self, header: dict, times: np.ndarray, readings: np.ndarray, params: dict):
+
+        opticalSkipFactor = int(params['opticalSkipFactor'])
+        opticalX = readings[::opticalSkipFactor, :, 0]
+        opticalTimes = times[::opticalSkipFactor]
+        self.numOptical, self.numMarkers = opticalX.shape
+        self.occlusionNumber = int(params['occlusionNumber'])
+
+        # same expression as engine.batchFuser, then stats.opticalErrors for an occluded reading
+        sine = params['amplitude'] * np.sin(2 * np.pi * params['frequency'] * opticalTimes)
+        driftedX = np.round(opticalX + sine[:, None] + params['verticalShift'], 4)
+        errors = exactRound(np.abs(opticalX - driftedX), 4)
+
+        self.oclFrameTarget = int(header['DataRate'] / opticalSkipFactor * params['occlusionDuration'])
+        groupLength = self.oclFrameTarget if self.oclFrameTarget > 0 else max(self.numOptical, 1)
+        self.groupStarts = np.arange(0, self.numOptical, groupLength)
+        self.sums = np.add.reduceat(errors, self.groupStarts, axis=0) if self.numOptical else np.zeros((0, self.numMarkers))
+        self.squareSums = np.add.reduceat(errors * errors, self.groupStarts, axis=0) if self.numOptical else np.zeros((0, self.numMarkers))
+
+    @staticmethod
+    def estimateBytes(readings: np.ndarray, params: dict, batchSize: int):
+        numOptical = -(-readings.shape[0] // int(params['opticalSkipFactor']))
+        return 4 * numOptical * readings.shape[1] * 8 + batchSize * numOptical * int(params['occlusionNumber']) * 8
+
+    def trialStats(self, seedSequences: list):
+    # (avgError, stdError) of every trial, shape (trials, 2).
+
+        count = self.numOptical * self.numMarkers
+        groups = np.empty((len(seedSequences), len(self.groupStarts), self.occlusionNumber), dtype=np.intp)
+        for trial, seedSequence in enumerate(seedSequences):
+            scheduler = TrialScheduler(self.numMarkers, self.occlusionNumber, self.oclFrameTarget, seedSequence)
+            groups[trial] = scheduler.advance(self.numOptical)[self.groupStarts]
+
+        spans = np.arange(len(self.groupStarts))[None, :, None]
+        total = self.sums[spans, groups].sum(axis=(1, 2))
+        squareTotal = self.squareSums[spans, groups].sum(axis=(1, 2))
+
+        average = total / count
+        variance = np.maximum(squareTotal / count - average * average, 0)
+        return np.column_stack([average, np.sqrt(variance)])
+
+def confidenceInterval(samples: np.ndarray, confidence: float):
+# Normal approximation interval of the mean of samples. Returns mean, standard deviation of the samples, low, high.
+
+    mean = float(np.mean(samples))
+    deviation = float(np.std(samples, ddof=1)) if len(samples) > 1 else float('inf')
+    halfWidth = NormalDist().inv_cdf(0.5 + confidence / 2) * deviation / np.sqrt(len(samples))
+    return mean, deviation, float(mean - halfWidth), float(mean + halfWidth)
+
+def summarizeTrials(trialStats: np.ndarray, confidence: float):
+# {stat: {'mean', 'std', 'ciLow', 'ciHigh'}} for every stat in TRIAL_STATS.
+
+    summary = {}
+    for column, name in enumerate(TRIAL_STATS):
+        mean, deviation, low, high = confidenceInterval(trialStats[:, column], confidence)
+        summary[name] = {'mean': mean, 'std': deviation, 'ciLow': low, 'ciHigh': high}
+    return summary
+
+def runMonteCarlo(inFilePath, params: dict, trials: int = 100, seed=None, confidence: float = 0.95, targetWidth: float = None,
+                  batchSize: int = 64, workers=None, memoryLimit: int = DEFAULT_MEMORY_LIMIT):
+    # Purpose:
+    # Runs up to trials trials of one configuration and returns the mean and confidence interval of every stat in TRIAL_STATS.
+    # Parameters:
+    # params: dict with amplitude, frequency, verticalShift, occlusionNumber, occlusionDuration, opticalSkipFactor and
+    #         optionally accumulateDrift.  seed: root of the SeedSequence the trial streams are spawned from.
+    # confidence: confidence level of the intervals.  targetWidth: stop early once every interval is narrower than this
+    #             (same units as the errors), None always runs every trial.
+    # batchSize: trials per vectorized batch / per round of pool jobs; early stopping is checked after each.
+    # workers: process pool size for the fallback path.  memoryLimit: bytes the vectorized pass may use.
+    # Returns a dict: the TRIAL_STATS summaries, 'trials' (trials run), 'stoppedEarly', 'vectorized' and
+    # 'trialStats' (shape (trials, 2), the avg/std error of every trial).
+
+    header, times, readings = loadTRCCached(inFilePath)
+    seedSequences = np.random.SeedSequence(seed).spawn(trials)
+
+    vectorized = (not params.get('accumulateDrift', False)
+                  and _GroupSums.estimateBytes(readings, params, batchSize) <= memoryLimit)
+
+    results = []
+    stoppedEarly = False
+    executor = None
+    try:
+        if vectorized:
+            groupSums = _GroupSums(header, times, readings, params)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(inFilePath,))
+
+        for start in range(0, trials, batchSize):
+            batch = seedSequences[start:start + batchSize]
+            if vectorized:
+                results.extend(groupSums.trialStats(batch))
+            else:
+                results.extend(executor.map(_runTrial, [params] * len(batch), batch))
+
+            if targetWidth is not None and len(results) >= MIN_TRIALS and len(results) < trials:
+                summary = summarizeTrials(np.array(results), confidence)
+                if all(stat['ciHigh'] - stat['ciLow'] < targetWidth for stat in summary.values()):
+                    stoppedEarly = True
+                    break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    trialStats = np.array(results, dtype=np.float64).reshape(-1, len(TRIAL_STATS))
+    report = summarizeTrials(trialStats, confidence)
+    report.update({'trials': len(trialStats), 'stoppedEarly': stoppedEarly, 'vectorized': vectorized, 'trialStats': trialStats})
+    return report
+
+if __name__ == '__main__':
+    freeze_support()
+
+    parser = argparse.ArgumentParser(description='Repeat the drift simulation over independently seeded occlusion patterns and report confidence intervals.')
+    parser.add_argument('inFilePath', help='input TRC file')
+    parser.add_argument('--trials', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None, help='root seed of the trial streams')
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--targetWidth', type=float, default=None, help='stop once every confidence interval is narrower than this')
+    addParameterArguments(parser)
+    parser.add_argument('--accumulateDrift', action='store_true', help='long term drift (see engine.runBatchSimulation), runs on the process pool')
+    parser.add_argument('--workers', type=int, default=None, help='process pool size (default: one per core)')
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name in SWEEP_PARAMETERS + ['accumulateDrift']}
+    report = runMonteCarlo(args.inFilePath, params, trials=args.trials, seed=args.seed, confidence=args.confidence,
+                           targetWidth=args.targetWidth, workers=args.workers)
+
+    print('%d trials%s' % (report['trials'], ' (stopped early)' if report['stoppedEarly'] else ''))
+    for name in TRIAL_STATS:
+        stat = report[name]
+        print('%s: %.5f  (%g%% CI %.5f .. %.5f, std over trials %.5f)' % (name, stat['mean'], args.confidence * 100, stat['ciLow'], stat['ciHigh'], stat['std']))
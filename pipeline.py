@@ -0,0 +1,176 @@
+import numbers
+import random
+
+from engine import GlobalRandomScheduler, OcclusionScheduler, finalInertialCounts, runBatchSimulation
+from kernels import runKernelSimulation
+from markergroups import MarkerGroups, loadMarkerGroups
+from profiling import NO_PROFILER, Profiler
+from resultcache import ResultCache
+from stats import ChunkedComparisonStats, comparisonStats
+from trcio import CHUNK_FRAMES, DEFAULT_PRECISION, loadTRCCached, readTRC, readTRCChunks, readTRCHeader, writeTRC, writeTRCBlock
+
+
+# One call simulate-and-score entry point: load (through the binary cache), occlude and drift, score against the optical
+# ground truth in memory, and only write the fused TRC if an output path is given.
+
+
+def _canonicalSeed(seed, numpySeeded: bool):
+# seed with integer types (numpy's included) as a plain int, so equal seeds give the same result cache key.
+# numpySeeded: the groups are drawn by numpy (OcclusionScheduler, kernel backend), which does not take str seeds.
+
+    if isinstance(seed, numbers.Integral):
+        return int(seed)
+    if isinstance(seed, str) and numpySeeded:
+        raise TypeError('seed %r: the scheduler and kernel backends are seeded through numpy and need an int seed' % seed)
+    return seed
+
+def runPipeline(inFilePath, amplitude: float, frequency: float, verticalShift: float, occlusionNumber: int, occlusionDuration: float,
+                opticalSkipFactor: int, outFilePath=None, seed=None, precision: int = DEFAULT_PRECISION, useScheduler: bool = False,
+                driftModel = None, accumulateDrift: bool = False, useCache: bool = True, profiler: Profiler = NO_PROFILER,
+                useKernel: bool = False, noRepeatGroups: bool = False, markerGroups = None, resultCache: ResultCache = None):
+    # Purpose:
+    # Runs the batch engine on inFilePath and returns (stats, fused).
+    # Parameters:
+    # amplitude, frequency, verticalShift: sine drift.  occlusionNumber, occlusionDuration, opticalSkipFactor: as in the __main__ block of simulation.py.
+    # outFilePath: write the fused TRC here, or None to skip writing.  seed: seeds the occlusion groups.  precision: decimals written per reading.
+    # useScheduler: draw the groups from an OcclusionScheduler seeded with seed, instead of the global 'random' state.
+    # driftModel: a drift.DriftModel replacing the sine drift (amplitude, frequency and verticalShift are then ignored).
+    # accumulateDrift: drift builds up with each marker's time since its last optical fix (see engine.accumulatedDrift).
+    # useCache: load through trcio.loadTRCCached. False parses the text directly and leaves no cache files behind (one-off runs).
+    # profiler: a profiling.Profiler timing the load, occluder, drifter, stats and writer stages.
+    # useKernel: run occlusion and drift on the kernel backend (kernels.runKernelSimulation, compiled when numba is installed),
+    #            groups seeded with seed like useScheduler. Sine drift only, no driftModel.
+    # noRepeatGroups: a new occlusion group never repeats a marker of the previous one. Only the kernel backend has this
+    #                 policy, so it implies useKernel.
+    # markerGroups: occlude whole marker groups (body segments) instead of single markers: a group definition file (see
+    #               markergroups.py) or a {group name: [marker names]} dict. occlusionNumber then counts groups.
+    # resultCache: a resultcache.ResultCache. A seeded run (int seed, or str seed on the global 'random' path, no driftModel) whose input contents and settings
+    #              were run before returns the stored result without simulating (the output is still written if asked for),
+    #              new results are stored.
+    # stats is the dict from stats.comparisonStats, fused the (frames, markers, 3) fused readings.
+
+    seed = _canonicalSeed(seed, useScheduler or useKernel or noRepeatGroups)
+    cacheKey = None
+    if resultCache is not None and isinstance(seed, (int, str)) and driftModel is None:
+        settings = {'amplitude': float(amplitude), 'frequency': float(frequency), 'verticalShift': float(verticalShift),
+                    'occlusionNumber': int(occlusionNumber), 'occlusionDuration': float(occlusionDuration),
+                    'opticalSkipFactor': int(opticalSkipFactor), 'seed': seed, 'useScheduler': bool(useScheduler),
+                    'accumulateDrift': bool(accumulateDrift), 'useKernel': bool(useKernel), 'noRepeatGroups': bool(noRepeatGroups),
+                    'markerGroups': markerGroups if markerGroups is None or isinstance(markerGroups, dict) else loadMarkerGroups(markerGroups)}
+        with profiler.stage('resultCache'):
+            cacheKey = resultCache.key(inFilePath, settings)
+            cached = resultCache.get(cacheKey)
+
+        if cached is not None:
+            stats, arrays = cached
+            if outFilePath is not None:
+                with profiler.stage('writer', len(arrays['times'])):
+                    writeTRC(outFilePath, readTRCHeader(inFilePath)['HeaderLines'], arrays['times'], arrays['fused'], precision)
+            return stats, arrays['fused']
+
+    with profiler.stage('load'):
+        header, times, readings = loadTRCCached(inFilePath) if useCache else readTRC(inFilePath)
+
+    if markerGroups is not None:
+        markerGroups = MarkerGroups(markerGroups, header['Markers'])
+    numUnits = readings.shape[1] if markerGroups is None else len(markerGroups)
+
+    if useKernel or noRepeatGroups:
+        if driftModel is not None:
+            raise ValueError('the kernel backend only simulates the sine drift, driftModel must be None')
+        fused, mask = runKernelSimulation(times, readings, header['DataRate'], opticalSkipFactor, occlusionDuration, occlusionNumber,
+                                          amplitude, frequency, verticalShift, seed,
+                                          groups=markerGroups.indexes if markerGroups is not None else None, noRepeat=noRepeatGroups,
+                                          accumulateDrift=accumulateDrift, profiler=profiler)
+    else:
+        scheduler = None
+        if useScheduler:
+            oclFrameTarget = int(header['DataRate'] / opticalSkipFactor * occlusionDuration)
+            scheduler = OcclusionScheduler(numUnits, occlusionNumber, oclFrameTarget, seed)
+        elif seed is not None:
+            random.seed(seed)
+
+        fused, mask = runBatchSimulation(times, readings, header['DataRate'], opticalSkipFactor, occlusionDuration, occlusionNumber,
+                                         amplitude, frequency, verticalShift, scheduler, driftModel, accumulateDrift, profiler,
+                                         markerGroups=markerGroups)
+
+    if outFilePath is not None:
+        with profiler.stage('writer', len(times)):
+            writeTRC(outFilePath, header['HeaderLines'], times, fused, precision)
+
+    with profiler.stage('stats', len(times)):
+        stats = comparisonStats(readings, fused, mask, opticalSkipFactor)
+
+    if cacheKey is not None:
+        with profiler.stage('resultCache'):
+            resultCache.put(cacheKey, stats, times=times, fused=fused)
+
+    return stats, fused
+
+def runChunkedPipeline(inFilePath, amplitude: float, frequency: float, verticalShift: float, occlusionNumber: int, occlusionDuration: float,
+                       opticalSkipFactor: int, outFilePath=None, seed=None, precision: int = DEFAULT_PRECISION, useScheduler: bool = False,
+                       driftModel = None, accumulateDrift: bool = False, chunkFrames: int = CHUNK_FRAMES, profiler: Profiler = NO_PROFILER,
+                       markerGroups = None):
+    # Purpose:
+    # Out of core runPipeline for captures larger than memory: the input is read, fused, written and scored one window of
+    # chunkFrames frames at a time, so peak memory depends on chunkFrames and the number of markers, not on the capture length.
+    # The occlusion groups, the drift models' state and the accumulated drift counts carry over from window to window, so
+    # the output file is the same as runPipeline's. Stateful drift models that integrate their own steps
+    # (BiasInstabilityDrift) may differ from a single window in the last bits before rounding.
+    # Parameters:
+    # Same as runPipeline (batch engine only, no kernel backend).  chunkFrames: frames per window.
+    # Returns the stats dict of stats.comparisonStats (no fused array: it is only ever held one window at a time).
+
+    seed = _canonicalSeed(seed, useScheduler)
+    header = readTRCHeader(inFilePath)
+    numMarkers = len(header['Markers'])
+    dataRate = header['DataRate']
+
+    if markerGroups is not None:
+        markerGroups = MarkerGroups(markerGroups, header['Markers'])
+    numUnits = numMarkers if markerGroups is None else len(markerGroups)
+
+    oclFrameTarget = int(dataRate / opticalSkipFactor * occlusionDuration)
+    if useScheduler:
+        scheduler = OcclusionScheduler(numUnits, occlusionNumber, oclFrameTarget, seed)
+    else:
+        if seed is not None:
+            random.seed(seed)
+        scheduler = GlobalRandomScheduler(numUnits, occlusionNumber, oclFrameTarget)
+
+    errorStats = ChunkedComparisonStats(numMarkers, opticalSkipFactor)
+    inertialCounts = None
+    firstFrame = 0
+
+    outputFile = open(outFilePath, 'w', newline='') if outFilePath is not None else None
+    try:
+        if outputFile is not None:
+            outputFile.writelines(header['HeaderLines'])
+
+        chunks = readTRCChunks(inFilePath, chunkFrames)
+        while True:
+            with profiler.stage('load', 0):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            times, readings = chunk
+
+            fused, mask = runBatchSimulation(times, readings, dataRate, opticalSkipFactor, occlusionDuration, occlusionNumber,
+                                             amplitude, frequency, verticalShift, scheduler, driftModel, accumulateDrift, profiler,
+                                             firstFrame, inertialCounts, markerGroups)
+            if accumulateDrift:
+                inertialCounts = finalInertialCounts(mask, inertialCounts)
+
+            if outputFile is not None:
+                with profiler.stage('writer', len(times)):
+                    writeTRCBlock(outputFile, firstFrame + 1, times, fused, precision)
+
+            with profiler.stage('stats', len(times)):
+                errorStats.update(readings, fused, mask)
+
+            firstFrame += len(times)
+    finally:
+        if outputFile is not None:
+            outputFile.close()
+
+    return errorStats.result()
@@ -0,0 +1,169 @@
+import json
+import os
+import sys
+import time
+
+
+# Built-in instrumentation for the pipeline stages. A Profiler collects one event per timed span (wall and CPU time,
+# frames processed) plus queue depth samples, and summarizes them per stage: calls, wall/CPU seconds, frames per second,
+# queue depths and the peak RSS of every process involved.
+# Disabled profilers hand out a shared do-nothing span, so instrumented code costs one method call per chunk when off.
+# Stages running in their own processes keep their own Profiler and send its events() to the parent, which merge()s them.
+# Timestamps are time.perf_counter() values, which share one clock across the processes of a machine.
+
+class _NullSpan:
+    # Returned by a disabled profiler: no timing, no allocation.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    __slots__ = ('profiler', 'name', 'frames', 'start', 'cpuStart')
+
+    def __init__(self, profiler, name: str, frames: int):
+        self.profiler = profiler
+        self.name = name
+        self.frames = frames
+
+    def __enter__(self):
+        self.cpuStart = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        wall = time.perf_counter() - self.start
+        self.profiler.spans.append((self.name, self.profiler.pid, self.start, wall, time.process_time() - self.cpuStart, self.frames))
+        return False
+
+
+def peakRSS():
+# Peak resident set size of this process in bytes, None where it cannot be read.
+
+    try:
+        import resource
+    except ImportError:         # Windows
+        resource = None
+
+    if resource is not None:
+        maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxRSS if sys.platform == 'darwin' else maxRSS * 1024    # bytes on macOS, kilobytes elsewhere
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memoryInfo = psutil.Process().memory_info()
+    return getattr(memoryInfo, 'peak_wset', memoryInfo.rss)
+
+
+class Profiler:
+    # Purpose:
+    # Records timed spans per stage and queue depth samples.
+    # Use:
+    # with profiler.stage('drifter', frames=len(chunk)):  ...
+    # profiler.queueDepth('inertialQueue', inertialQueue)
+
+    def __init__(self, enabled: bool = True, processName: str = 'main'):
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self.processNames = {self.pid: processName}
+        self.spans = []             # (stage, pid, start, wall, cpu, frames)
+        self.queueSamples = []      # (queue name, pid, time, depth)
+        self.peakRSS = {}           # pid -> bytes
+
+    def stage(self, name: str, frames: int = 0):
+    # Context manager timing one span of stage name, which processed frames frames.
+
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, frames)
+
+    def queueDepth(self, name: str, queue):
+    # Samples the number of items waiting in a multiprocessing Queue.
+
+        if not self.enabled:
+            return
+        try:
+            depth = queue.qsize()
+        except NotImplementedError:     # macOS has no sem_getvalue
+            return
+        self.queueSamples.append((name, self.pid, time.perf_counter(), depth))
+
+    def forProcess(self, processName: str):
+    # A profiler for a stage process, enabled like this one. Call it in the child so it records the child's pid.
+
+        return Profiler(self.enabled, processName)
+
+    def events(self):
+    # Everything recorded by this process, to send to the parent.
+
+        return {'pid': self.pid, 'processNames': self.processNames, 'spans': self.spans, 'queueSamples': self.queueSamples,
+                'peakRSS': {self.pid: peakRSS()}}
+
+    def merge(self, events: dict):
+    # Adds the events() of another process.
+
+        self.processNames.update({int(pid): name for pid, name in events['processNames'].items()})
+        self.spans.extend(tuple(span) for span in events['spans'])
+        self.queueSamples.extend(tuple(sample) for sample in events['queueSamples'])
+        self.peakRSS.update({int(pid): rss for pid, rss in events['peakRSS'].items()})
+
+    def summary(self):
+    # {'stages': {stage: calls, wallSeconds, cpuSeconds, frames, fps}, 'queues': {queue: samples, meanDepth, maxDepth},
+    #  'peakRSS': {process name: bytes}}
+
+        self.peakRSS[self.pid] = peakRSS()
+
+        stages = {}
+        for name, pid, start, wall, cpu, frames in self.spans:
+            stage = stages.setdefault(name, {'calls': 0, 'wallSeconds': 0.0, 'cpuSeconds': 0.0, 'frames': 0})
+            stage['calls'] += 1
+            stage['wallSeconds'] += wall
+            stage['cpuSeconds'] += cpu
+            stage['frames'] += frames
+        for stage in stages.values():
+            stage['fps'] = stage['frames'] / stage['wallSeconds'] if stage['frames'] and stage['wallSeconds'] > 0 else None
+
+        queues = {}
+        for name, pid, sampledAt, depth in self.queueSamples:
+            queues.setdefault(name, []).append(depth)
+        queues = {name: {'samples': len(depths), 'meanDepth': sum(depths) / len(depths), 'maxDepth': max(depths)}
+                  for name, depths in queues.items()}
+
+        rss = {self.processNames.get(pid, str(pid)): value for pid, value in self.peakRSS.items()}
+        return {'stages': stages, 'queues': queues, 'peakRSS': rss}
+
+    def writeJSON(self, filePath):
+    # Writes summary() as JSON.
+
+        with open(filePath, 'w') as outputFile:
+            json.dump(self.summary(), outputFile, indent=2)
+        return
+
+    def writeChromeTrace(self, filePath):
+    # Writes the spans and queue depths in the Chrome trace event format (chrome://tracing, Perfetto): one lane per process,
+    # complete events for the spans and counter events for the queue depths.
+
+        starts = [span[2] for span in self.spans] + [sample[2] for sample in self.queueSamples]
+        origin = min(starts) if starts else 0.0
+
+        traceEvents = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': pid, 'args': {'name': name}}
+                       for pid, name in self.processNames.items()]
+        for name, pid, start, wall, cpu, frames in self.spans:
+            traceEvents.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': pid, 'ts': (start - origin) * 1e6, 'dur': wall * 1e6,
+                                'args': {'cpuMs': cpu * 1e3, 'frames': frames}})
+        for name, pid, sampledAt, depth in self.queueSamples:
+            traceEvents.append({'name': name, 'ph': 'C', 'pid': pid, 'tid': pid, 'ts': (sampledAt - origin) * 1e6, 'args': {'depth': depth}})
+
+        with open(filePath, 'w') as outputFile:
+            json.dump({'traceEvents': traceEvents, 'displayTimeUnit': 'ms'}, outputFile)
+        return
+
+NO_PROFILER = Profiler(enabled=False)     # default for instrumented functions
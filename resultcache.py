@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+from trcio import _saveAtomically
+
+
+# Content addressed cache of simulation results, for sweeps and notebooks that run the same configuration again.
+# An entry is one .npz file holding the arrays (fused readings, times) and the stats dict of one runPipeline call, named
+# after a hash of everything that determines them: the contents of the input file and the simulation settings (seed included).
+# Only seeded runs are cached: without a seed every run draws different occlusion groups, so there is nothing to reuse.
+# Entries are evicted least recently used first (a hit refreshes the file's modification time) once the cache holds more
+# than maxBytes.
+
+RESULT_CACHE_DIR = '.result_cache'
+DEFAULT_MAX_BYTES = 2 << 30     # 2 GiB
+CACHE_VERSION = 1               # part of every key: bump when a change to the engine alters results
+_STATS_PREFIX = 'stats.'
+
+# content hashes of the input files hashed by this process, by (path, size, modification time)
+_fileDigests = {}
+
+
+def fileDigest(filePath):
+# SHA-256 of the contents of filePath. Hashed once per version of the file per process.
+
+    stat = os.stat(filePath)
+    versionKey = (os.path.abspath(filePath), stat.st_size, stat.st_mtime_ns)
+    if versionKey not in _fileDigests:
+        digest = hashlib.sha256()
+        with open(filePath, 'rb') as inFile:
+            for block in iter(lambda: inFile.read(1 << 20), b''):
+                digest.update(block)
+        _fileDigests[versionKey] = digest.hexdigest()
+    return _fileDigests[versionKey]
+
+class ResultCache:
+    # Purpose:
+    # On disk cache of results: a stats dict (values: numbers or arrays) and any number of named arrays.
+    # Use:
+    # key = cache.key(inFilePath, settings);  entry = cache.get(key);  if entry is None: ...;  cache.put(key, stats, fused=fused)
+    # Parameters:
+    # cacheDir: folder of the entries, created on first put().  maxBytes: total size the entries are trimmed to after every put().
+
+    def __init__(self, cacheDir=RESULT_CACHE_DIR, maxBytes: int = DEFAULT_MAX_BYTES):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+
+    def key(self, inFilePath, settings: dict):
+    # Key of the result of inFilePath under settings (a JSON serializable dict of everything else the result depends on).
+
+        description = json.dumps({'version': CACHE_VERSION, 'input': fileDigest(inFilePath), 'settings': settings}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.cacheDir, key + '.npz')
+
+    def get(self, key: str):
+    # (stats, {name: array}) stored under key, or None.
+
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                stats, arrays = {}, {}
+                for name in entry.files:
+                    value = entry[name]
+                    if name.startswith(_STATS_PREFIX):
+                        stats[name[len(_STATS_PREFIX):]] = value.item() if value.ndim == 0 else value
+                    else:
+                        arrays[name] = value
+        except (OSError, ValueError, zipfile.BadZipFile):     # missing, evicted meanwhile or unreadable
+            return None
+
+        try:
+            os.utime(path)                              # most recently used
+        except OSError:
+            pass
+        return stats, arrays
+
+    def put(self, key: str, stats: dict, **arrays):
+    # Stores a result, then evicts the least recently used entries over maxBytes.
+
+        os.makedirs(self.cacheDir, exist_ok=True)
+        entry = dict(arrays, **{_STATS_PREFIX + name: value for name, value in stats.items()})
+        _saveAtomically(self._path(key), lambda outputFile: np.savez(outputFile, **entry))     # an entry only exists once it is complete
+
+        self.evict()
+        return
+
+    def entries(self):
+    # (path, size, last use) of every entry, least recently used first.
+
+        if not os.path.isdir(self.cacheDir):
+            return []
+
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if name.endswith('.npz'):
+                path = os.path.join(self.cacheDir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime_ns))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+    # Removes the least recently used entries until the cache holds at most maxBytes. Returns the number removed.
+
+        entries = self.entries()
+        totalBytes = sum(size for path, size, lastUse in entries)
+        removed = 0
+        for path, size, lastUse in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            totalBytes -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        for path, size, lastUse in self.entries():
+            os.remove(path)
+        return
@@ -1,13 +1,26 @@
 from trc import TRCData
 import time
-import copy
 import random
+import queue
 from multiprocessing import Process, freeze_support, Queue
 
 
 import numpy as np
 import matplotlib.pyplot as plt
 
+from engine import OcclusionScheduler, batchFuserInPlace, drawOcclusionGroup, exactRound, trcToArrays
+from pipeline import runPipeline
+from profiling import NO_PROFILER, Profiler
+from stats import OnlineErrorStats
+from trcio import DEFAULT_PRECISION, readTRC, readTRCHeader, writeTRCBlock
+
+
+FRAME_CHUNK_SIZE = 256   # frames per queue item. Sending chunks instead of single frames cuts the per-item pickling cost.
+QUEUE_CHUNK_LIMIT = 8    # max chunks waiting in each queue, keeps memory flat for any file length.
+STREAM_END = None        # sentinel put on the queues after the last chunk
+STATS_SNAPSHOT_CHUNKS = 16  # live stats: the fuser reports a snapshot every this many chunks
+STAGE_POLL_INTERVAL = 0.1   # seconds between checks on the stage processes while waiting for them
+
 
 # 1st index is frame number. [1] is frame 1
 # 2nd index: [1][0] is the time for that frame
@@ -28,7 +41,7 @@ def drifter( inertialFrame: tuple, opticalFrame: tuple, markers: list, amplitude
     for marker in markers:
         if opticalFrame[1][index] == 'N/A':
             opticalFrame[1][index] = (0,0,0)
-            # markers[index] = ( marker[0], marker[1] + 1, marker[2])  # increase consecutive inertial frame count.  Used in a later version to model long term drift accumulation.
+            # markers[index] = ( marker[0], marker[1] + 1, marker[2])  # increase consecutive inertial frame count.  Long term drift accumulation: see engine.consecutiveInertialCounts.
             opticalFrame[1][index] = addDriftToReading( inertialFrame[1][index],  inertialFrame[0], amplitude, frequency, verticalShift)
             
         index += 1
@@ -43,10 +56,18 @@ def addDriftToReading( readingXYZ: tuple, time: float, amplitude: float, frequen
     return readingXYZ
 
 def occluder( opticalFrame: tuple, opticalFPS: int, occlusionDuration: float, occlusionNumber: int, markers: list):
+# Occludes group of markers from opticalFrame. See occlusionGroup() for the parameters.
+
+    for markerIndexes in occlusionGroup(opticalFPS, occlusionDuration, occlusionNumber, markers):
+        opticalFrame[1][markerIndexes] = 'N/A'
+
+    return opticalFrame
+
+def occlusionGroup( opticalFPS: int, occlusionDuration: float, occlusionNumber: int, markers: list):
     # Purpose: 
-    # Occludes group of markers from opticalFrame.
+    # Picks the group of markers occluded from the next optical frame and updates their occluded frame counts.
     # Parameters:
-    # opticalFrame: occlude random group of markers from this frame.  opticalFPS: to calculate how many frames must be occluded for a group
+    # opticalFPS: to calculate how many frames must be occluded for a group
     # occlusionDuration: How long in seconds a group should be occluded for. occlusionNumber: number of markers to be occluded at a time
     # markers: array of marker objects.
 
@@ -56,7 +77,7 @@ def occluder( opticalFrame: tuple, opticalFPS: int, occlusionDuration: float, oc
                     # seed first random group
     # case 2: a group is at end of occlusion cycle
                     # seed new random group
-    # in both cases: remove optical reading, increasae occluded frame count
+    # in both cases: increasae occluded frame count, the caller removes the optical readings
 
     oclFrameTarget = int(opticalFPS * occlusionDuration)  # 'int' might run into problems later
     oclGroupIndexes = []
@@ -68,11 +89,7 @@ def occluder( opticalFrame: tuple, opticalFPS: int, occlusionDuration: float, oc
             break
 
     if programStart:                   # Yes? Seed first random group
-        for _ in range( 0, occlusionNumber ):
-            random_num = random.randint(0, len(markers) - 1)
-            while random_num in oclGroupIndexes:
-                random_num = random.randint(0, len(markers) - 1)
-            oclGroupIndexes.append(random_num)
+        oclGroupIndexes = drawOcclusionGroup(len(markers), occlusionNumber)
 
     else:                           # No? Find current random group
         index = 0
@@ -88,17 +105,11 @@ def occluder( opticalFrame: tuple, opticalFPS: int, occlusionDuration: float, oc
                 markers[index] = (markers[index][0], 0, 0 )
                 index +=1
 
-            oclGroupIndexes = []             # seed new random group
-            for _ in range( 0, occlusionNumber ):
-                random_num = random.randint(0, len(markers) - 1)
-                while random_num in oclGroupIndexes:
-                    random_num = random.randint(0, len(markers) - 1)
-                oclGroupIndexes.append(random_num)
+            oclGroupIndexes = drawOcclusionGroup(len(markers), occlusionNumber)   # seed new random group
 
-    # Given a new or pre-existing random group from above, increase ocl count and remove readings
+    # Given a new or pre-existing random group from above, increase ocl count
     for markerIndexes in oclGroupIndexes:
         markers[markerIndexes] = (markers[markerIndexes][0], markers[markerIndexes][1], markers[markerIndexes][2] + 1)    # increase occluded frame count
-        opticalFrame[1][markerIndexes] = 'N/A'
 
     # remove consecutive inertial frame count for markers not in ocl group       # Drifter function will increase CIFC count. 
     # count = 0
@@ -108,10 +119,11 @@ def occluder( opticalFrame: tuple, opticalFPS: int, occlusionDuration: float, oc
     #     count += 1
     # we do not use consecutive inertial frame count as of now, because we are not tracking longterm drift.
 
-    return opticalFrame
+    return oclGroupIndexes
 
 def removeReading(TRCframe: TRCData, groups: list, markersNamesFrameOrder: list):
 # Input: TRC frame.  Group: list of strings for the readings that need removing. 
+# Scans every name of the group for every marker. Group occlusion now resolves the names once, see markergroups.MarkerGroups.
 
     count = 0
     for names in markersNamesFrameOrder:
@@ -141,96 +153,275 @@ def createMarkerObjectList(markerNames: list):
     return 
 
 def fuser(inertialQueue: Queue, opticalQueue: Queue, fusedQueue: Queue, opticalFPS: int, oclDuration: float, occlusionNumber: int, 
-          markers: list, amplitude: float, frequency: float, verticalShift: float, frameNum: int):
-
-    currFrameCount = 0
-    bothQueueGrabCounter = 0
-    while currFrameCount < frameNum:
-
-        if bothQueueGrabCounter == 0:   # get optical and inertial
-
-            inertFrame = inertialQueue.get()
-            opticFrame = opticalQueue.get()
-            occludedOptical = occluder(opticFrame, opticalFPS, oclDuration, occlusionNumber, markers)   
-            driftedFused = drifter(inertFrame, occludedOptical, markers, amplitude, frequency, verticalShift)
-            fusedQueue.put(driftedFused)
-        else:                               # just get inertial, create empty frame to pass to drifter for a complete filling of readings.
-            
-            inertFrame = inertialQueue.get()
-            emptyFrame = copy.deepcopy(inertFrame) # awkward, but because the drifter fills in empty readings with inertial readings, thus we need fully empty TRC frame
-            count = 0
-            for reading in emptyFrame[1]:
-                emptyFrame[1][count] = 'N/A'
-                count += 1
-            
-            driftedFused = drifter( inertFrame, emptyFrame, markers, amplitude, frequency, verticalShift)
-            fusedQueue.put(driftedFused)
-    
-        currFrameCount += 1
-        bothQueueGrabCounter =  bothQueueGrabCounter + 1
-        if bothQueueGrabCounter == 4:
-            bothQueueGrabCounter = 0
+          markers: list, amplitude: float, frequency: float, verticalShift: float, opticalSkipFactor: int, seed = None,
+          metricsQueue: Queue = None, snapshotEvery: int = STATS_SNAPSHOT_CHUNKS, useScheduler: bool = False, chunkSize: int = FRAME_CHUNK_SIZE,
+          profiler: Profiler = NO_PROFILER, liveStats: bool = True):
+# Frames arrive in chunks of arrays: (feed time, times, readings) from the inertial queue, and the readings of the optical frames
+# that fall inside it (possibly none) from the optical queue. Runs until the feeder's STREAM_END sentinel, which is passed on to the writer.
+# Each chunk is fused in place in the inertial array it arrived in, with a validity mask (True = optical reading kept) in place of
+# 'N/A' readings. The mask is allocated once for chunkSize frames and reused, so no objects are created per frame.
+# seed: seeds the occlusion groups. Needed when the fuser runs in its own process, since 'random' is reseeded in every child.
+# metricsQueue: with liveStats, the x-axis error of every optical frame goes into an OnlineErrorStats as frames leave the fuser.
+#               A ('stats', snapshot) is sent every snapshotEvery chunks and a ('statsFinal', snapshot) at the end.
+# useScheduler: occlude with an OcclusionScheduler seeded with seed instead of occlusionGroup() and the global 'random' state.
+# profiler: if enabled, 'occluder' and 'drifter' are timed per chunk, the queue depths sampled, and the events sent on metricsQueue as ('profile-fuser', events).
+
+    profiler = profiler.forProcess('fuser')
+    scheduler = None
+    if useScheduler:
+        scheduler = OcclusionScheduler(len(markers), occlusionNumber, int(opticalFPS * oclDuration), seed)
+    elif seed is not None:
+        random.seed(seed)
+
+    errorStats = OnlineErrorStats() if (liveStats and metricsQueue is not None) else None
+    chunkCount = 0
+
+    validBuffer = np.zeros((chunkSize, len(markers)), dtype=bool)
+    framesFused = 0
+    while True:
+
+        inertItem = inertialQueue.get()
+        opticChunk = opticalQueue.get()
+        if inertItem is STREAM_END:
+            fusedQueue.put(STREAM_END)
+            if errorStats is not None:
+                metricsQueue.put(('statsFinal', errorStats.snapshot()))
+            if profiler.enabled:
+                metricsQueue.put(('profile-fuser', profiler.events()))
+            break
+        sentAt, times, readings = inertItem
+
+        numFrames = len(times)
+        if numFrames > len(validBuffer):
+            validBuffer = np.zeros((numFrames, len(markers)), dtype=bool)
+        valid = validBuffer[:numFrames]
+        valid[:] = False
+
+        profiler.queueDepth('inertialQueue', inertialQueue)
+
+        opticalRows = slice((-framesFused) % opticalSkipFactor, numFrames, opticalSkipFactor)   # every opticalSkipFactor-th frame of the stream is optical
+        opticalValid = valid[opticalRows]
+        with profiler.stage('occluder', numFrames):
+            opticalValid[:] = True
+            for opticalIndex in range(len(opticChunk)):
+                if scheduler is not None:
+                    opticalValid[opticalIndex, scheduler.next()] = False
+                else:
+                    opticalValid[opticalIndex, occlusionGroup(opticalFPS, oclDuration, occlusionNumber, markers)] = False
+
+        if errorStats is not None:
+            truthX = readings[opticalRows, :, 0].copy()
+
+        with profiler.stage('drifter', numFrames):
+            batchFuserInPlace(times, readings, valid, amplitude, frequency, verticalShift)
+            np.copyto(readings[opticalRows], opticChunk, where=opticalValid[:, :, None])   # visible markers take the optical reading
+
+        profiler.queueDepth('fusedQueue', fusedQueue)
+        fusedQueue.put((sentAt, times, readings))
+        framesFused += numFrames
+
+        if errorStats is not None:
+            errorStats.update(exactRound(np.abs(truthX - readings[opticalRows, :, 0]).ravel(), 4))
+            chunkCount += 1
+            if chunkCount % snapshotEvery == 0:
+                metricsQueue.put(('stats', errorStats.snapshot()))
 
     return
 
-def feederFunc( data: TRCData, fps: int, inertialQueue: Queue, opticalQueue: Queue,  opticalSkipFactor: int, frameCount: int ):
-# forever feeds TRC frames, from a file that is fully read in, into a queue based on fps. skip factor: if set to 1, reads every frame. If set to 4, sends every 4th frame.
-
-    # interval = 1/fps
-    frameNum = -1          # is actually -1 than actual value, to allow for opticalSkipFactor modding to provide first frame as optical
-    
-    # time1 = (time.monotonic())
-
-    while (frameNum + 1)  < frameCount :
-
-        # time2 = (time.monotonic())
-
-        # while (time2 - time1) < interval:
-        #     time2 = (time.monotonic())
-        # time1 = time2
-         
-        frameNum += 1
-        
-        inertialQueue.put(data[frameNum + 1]) 
-        if (frameNum % opticalSkipFactor ) == 0:
-            opticalQueue.put(data[frameNum + 1])          # "+ 1" to provide a optical frame for the first reading: 0 % 4 = 0
+def feederFunc( times: np.ndarray, readings: np.ndarray, fps: int, inertialQueue: Queue, opticalQueue: Queue,  opticalSkipFactor: int, chunkSize: int = FRAME_CHUNK_SIZE,
+                realTime: bool = False, metricsQueue: Queue = None, profiler: Profiler = NO_PROFILER ):
+# feeds frames, from a file that is fully read in (engine.trcToArrays), into the queues in chunks of chunkSize frames. skip factor: if set to 1, reads every frame. If set to 4, sends every 4th frame.
+# Chunks are slices of the arrays: (feed time, times, readings) on the inertial queue, and the readings of the optical frames inside
+# the same frames on the optical queue, so the fuser can pair them up. Ends both streams with STREAM_END.
+# The feed time lets the writer measure feed to output latency.
+# realTime: frame n is due at start + n/fps. The feeder sleeps until each deadline instead of spinning, optical frames follow at the skip-factor rate.
+# metricsQueue: if given, the lateness of every chunk against its deadline is sent on it at the end, as ('feeder', latenessList).
+# profiler: if enabled, every chunk hand-off is timed (including waits on a full queue) and the events sent on metricsQueue as ('profile-feeder', events).
+
+    profiler = profiler.forProcess('feeder')
+    interval = 1/fps
+    frameCount = len(times)
+    lateness = []
+
+    startTime = time.perf_counter()
+    for start in range(0, frameCount, chunkSize):
+        stop = min(start + chunkSize, frameCount)
+        lastFrame = stop - 1
+
+        if realTime:
+            deadline = startTime + lastFrame * interval
+            remaining = deadline - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+
+        sentAt = time.perf_counter()
+        if metricsQueue is not None:
+            lateness.append(sentAt - (startTime + lastFrame * interval))
+
+        with profiler.stage('feeder', stop - start):
+            inertialQueue.put((sentAt, times[start:stop], readings[start:stop]))
+            opticalQueue.put(readings[start + (-start) % opticalSkipFactor:stop:opticalSkipFactor])    # first frame is optical: 0 % 4 = 0
+
+    inertialQueue.put(STREAM_END)
+    opticalQueue.put(STREAM_END)
+    if realTime and metricsQueue is not None:
+        metricsQueue.put(('feeder', lateness))
+    if profiler.enabled:
+        metricsQueue.put(('profile-feeder', profiler.events()))
     return
 
-def writeToOutfile( fusedQueue, inFilePath, outFilePath ):
-
-    inFile = open(inFilePath, 'r')
-    outputFile = open(outFilePath, 'w')
+def writeToOutfile( fusedQueue, headerLines: list, outFilePath, metricsQueue: Queue = None, precision: int = DEFAULT_PRECISION,
+                    realTime: bool = False, profiler: Profiler = NO_PROFILER ):
+# Writes fused chunks as they arrive, until the fuser's STREAM_END sentinel. Each chunk is formatted and written as one block.
+# headerLines: header of the input file (trcio.readTRCHeader), copied to the output.  precision: decimals written per reading.
+# metricsQueue: with realTime, the feed to output latency of every chunk is sent on it at the end, as ('writer', latencyList).
+# profiler: if enabled, formatting and writing every chunk is timed and the events sent on metricsQueue as ('profile-writer', events).
 
-    # write header from original file to output file
-    for _ in range(6):
-        header = inFile.readline()
-        outputFile.write(header)
-    inFile.close()
+    profiler = profiler.forProcess('writer')
+    outputFile = open(outFilePath, 'w', newline='')
+    outputFile.writelines(headerLines)
 
+    latencies = []
     count = 1 
-    for _ in range(int(numFrames)):
-        frame = fusedQueue.get()
-        outputFile.write(str(count))
-        outputFile.write("\t")
-        outputFile.write(str(frame[0]))
-        outputFile.write("\t")
-        for readingsTriplet in frame[1]:
-            outputFile.write(str(readingsTriplet[0]))
-            outputFile.write("\t")
-            outputFile.write(str(readingsTriplet[1]))
-            outputFile.write("\t")
-            outputFile.write(str(readingsTriplet[2]))
-            outputFile.write("\t")
-        outputFile.write("\n")
-        count += 1
+    while True:
+        fusedItem = fusedQueue.get()
+        if fusedItem is STREAM_END:
+            break
+        sentAt, times, readings = fusedItem
+        profiler.queueDepth('fusedQueue', fusedQueue)
+        with profiler.stage('writer', len(times)):
+            writeTRCBlock(outputFile, count, times, readings, precision)
+        count += len(times)
+        if realTime:
+            latencies.append(time.perf_counter() - sentAt)
     outputFile.close()
+
+    if realTime:
+        metricsQueue.put(('writer', latencies))
+    if profiler.enabled:
+        metricsQueue.put(('profile-writer', profiler.events()))
     return
 
+def realTimeMetrics(lateness: list, latencies: list, fps: float):
+# Summarizes a real time run. All times in milliseconds.
+# lateness: how late each frame was fed against its schedule (jitter).  latencies: feed to fused output time of each frame.
+# A frame misses its deadline when its fused output is written more than one frame interval after it was due.
+
+    lateness = np.asarray(lateness) * 1000
+    latencies = np.asarray(latencies) * 1000
+    interval = 1000 / fps
+    jitter = np.percentile(lateness, [50, 95, 99])
+    latency = np.percentile(latencies, [50, 95, 99])
+
+    return {
+        'frames': len(latencies),
+        'fps': fps,
+        'deadlineMisses': int(np.count_nonzero(lateness + latencies > interval)),
+        'jitterP50': float(jitter[0]), 'jitterP95': float(jitter[1]), 'jitterP99': float(jitter[2]), 'jitterMax': float(lateness.max()),
+        'latencyMean': float(latencies.mean()), 'latencyP50': float(latency[0]), 'latencyP95': float(latency[1]), 'latencyP99': float(latency[2]),
+        'latencyMax': float(latencies.max()),
+    }
+
+def runStreamingPipeline( data: TRCData, inFilePath, outFilePath, opticalSkipFactor: int, occlusionDuration: float, occlusionNumber: int,
+                          amplitude: float, frequency: float, verticalShift: float, chunkSize: int = FRAME_CHUNK_SIZE, queueSize: int = QUEUE_CHUNK_LIMIT, seed = None,
+                          realTime: bool = False, playbackFPS: float = None, liveStats: bool = False, onStatsSnapshot = None, useScheduler: bool = False,
+                          frameDtype = np.float64, profile: bool = False ):
+# Runs feeder, fuser and writer as three concurrent processes. Queues are bounded to queueSize chunks, so at most a few chunks
+# are in flight at a time and memory stays flat no matter how long the file is.
+# If a stage dies, the others are terminated and a RuntimeError is raised.
+# realTime: feed one frame at a time at playbackFPS (default: the file's DataRate), report['realTime'] holds realTimeMetrics().
+# liveStats: keep streaming error stats in the fuser. onStatsSnapshot(snapshot) is called with every snapshot while the
+#            pipeline runs, report['stats'] holds the final one.
+# useScheduler: occlude with a seeded OcclusionScheduler instead of occluder().
+# frameDtype: dtype of the reading arrays sent between the stages. np.float32 halves the queue traffic, but the output is then
+#             only float32 accurate. The default float64 gives the same output as the batch engine.
+# profile: instrument every stage, report['profile'] holds the profiling.Profiler with the events of all processes
+#          (summary(), writeJSON(), writeChromeTrace()).
+# Returns the report dict (empty if none of these is on).
+
+    inertialFPS = data['DataRate']
+    opticalFPS = inertialFPS/opticalSkipFactor
+    markers = createMarkerObjectList(data['Markers'])
+    feedFPS = playbackFPS if playbackFPS else inertialFPS
+    headerLines = readTRCHeader(inFilePath)['HeaderLines']
+    profiler = Profiler(profile)
+    with profiler.stage('load', data['NumFrames']):
+        times, readings = trcToArrays(data)
+        readings = readings.astype(frameDtype, copy=False)
+
+    metricsQueue = Queue() if (realTime or liveStats or profile) else None
+    if realTime:
+        chunkSize = 1
+
+    inertialQueue = Queue(maxsize=queueSize)
+    opticalQueue = Queue(maxsize=queueSize)
+    fusedQueue = Queue(maxsize=queueSize)
+
+    stages = [
+        Process(target=feederFunc, name='feeder', args=(times, readings, feedFPS, inertialQueue, opticalQueue, opticalSkipFactor, chunkSize,
+                                                       realTime, metricsQueue, profiler)),
+        Process(target=fuser, name='fuser', args=(inertialQueue, opticalQueue, fusedQueue, opticalFPS, occlusionDuration, occlusionNumber,
+                                    markers, amplitude, frequency, verticalShift, opticalSkipFactor, seed, metricsQueue),
+                kwargs={'useScheduler': useScheduler, 'chunkSize': chunkSize, 'profiler': profiler, 'liveStats': liveStats}),
+        Process(target=writeToOutfile, name='writer', args=(fusedQueue, headerLines, outFilePath, metricsQueue, DEFAULT_PRECISION, realTime, profiler)),
+    ]
+    for stage in stages:
+        stage.start()
+
+    pending = set()                     # drain the metrics before joining, a child does not exit while it still has queued data
+    if realTime:
+        pending.update(['feeder', 'writer'])
+    if liveStats:
+        pending.add('statsFinal')
+    if profile:
+        pending.update(['profile-feeder', 'profile-fuser', 'profile-writer'])
+    stageMetrics = {}
+    while pending or any(stage.is_alive() for stage in stages):
+        failed = [stage for stage in stages if stage.exitcode not in (None, 0)]
+        if failed:                      # the other stages would block forever on its queues
+            for stage in stages:
+                if stage.is_alive():
+                    stage.terminate()
+                stage.join()
+            raise RuntimeError('pipeline stage %s exited with code %s' % (failed[0].name, failed[0].exitcode))
+
+        if not pending:
+            for stage in stages:
+                if stage.is_alive():
+                    stage.join(STAGE_POLL_INTERVAL)
+                    break
+            continue
+        try:
+            name, values = metricsQueue.get(timeout=STAGE_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if name in ('stats', 'statsFinal') and onStatsSnapshot is not None:
+            onStatsSnapshot(values)
+        if name.startswith('profile-'):
+            profiler.merge(values)
+        stageMetrics[name] = values
+        pending.discard(name)
+
+    for stage in stages:
+        stage.join()
+
+    for stage in stages:
+        if stage.exitcode != 0:
+            raise RuntimeError('pipeline stage %s exited with code %s' % (stage.name, stage.exitcode))
+
+    report = {}
+    if realTime:
+        report['realTime'] = realTimeMetrics(stageMetrics['feeder'], stageMetrics['writer'], feedFPS)
+    if liveStats:
+        report['stats'] = stageMetrics['statsFinal']
+    if profile:
+        report['profile'] = profiler
+    return report
+
 def produceOpticalComparisonStats( opticalTRCData, outFilePath, numFrames, numMarkers, opticalSkipFactor: int ):
 # because drift was only added in the x axis, error only needs to be calculated in the x-axis
 
-    simulatedHybridTRCData = TRCData()
-    simulatedHybridTRCData.load(outFilePath)
+    simulatedHybridReadings = readTRC(outFilePath)[2].tolist()
 
     errorValues = []
     errorSum = 0
@@ -243,7 +434,7 @@ def produceOpticalComparisonStats( opticalTRCData, outFilePath, numFrames, numMa
         if grabFrameCounter == 0:
             currMarker = 0
             while currMarker < numMarkers:
-                error = round( abs(opticalTRCData[currFrame][1][currMarker][0] - simulatedHybridTRCData[currFrame][1][currMarker][0]),  4)
+                error = round( abs(opticalTRCData[currFrame][1][currMarker][0] - simulatedHybridReadings[currFrame - 1][currMarker][0]),  4)
                 errorSum += error
                 errorValues.append(error)
                 currMarker += 1
@@ -273,31 +464,52 @@ if __name__ == '__main__':
     occlusionNumber = 25 # how many markers to occlude at any given time (0-49)
     occlusionDuration = 10 # how long an occlusion for a given marker lasts, in seconds.
     opticalSkipFactor = 4 # Inertial fps = 120, thus optical optical fps = 30
+    # Engine
+    useBatchEngine = True # True: vectorized engine.py pipeline. False: streaming feeder/fuser/writer processes. Same output for the same seed.
+    realTime = False      # streaming pipeline only: feed frames at the file's DataRate and print latency/jitter metrics.
+    writeOutput = True    # batch engine only: False skips writing outFilePath, stats are computed in memory either way.
+    liveStats = False     # streaming pipeline only: print running error stats (mean, std, P50/P95/P99) while the file streams.
+    accumulateDrift = False # batch engine only: the sine is a drift rate integrated over each marker's time since its last optical fix (consecutive inertial frame count), so drift grows until the marker is seen again.
+    useKernel = False     # batch engine only: occlude and drift in the kernel backend (kernels.py, compiled if numba is installed).
+    noRepeatGroups = False  # batch engine only (kernel backend): a new occlusion group never repeats a marker of the previous one.
+    profile = False       # time every stage (wall/CPU time, fps, queue depths, peak RSS), print the summary and write profilePath / tracePath.
     # File Paths
     inFilePath = r'C:\Users\lando\OneDrive\Desktop\Research_Project\Code\Graphing_Code\trc_original.trc'
     outFilePath = r'C:\Users\lando\OneDrive\Desktop\Research_Project\Code\Graphing_Code\output.trc'
-
-    inTRCData = TRCData()
-    inTRCData.load(inFilePath)
-    numFrames = inTRCData['NumFrames']    
-    allMarkerNames = inTRCData['Markers']
-    inertialFPS = inTRCData['DataRate']
-    opticalFPS = inertialFPS/opticalSkipFactor
-    markers = createMarkerObjectList(allMarkerNames)
-
-    inertialQueue = Queue()
-    opticalQueue = Queue()
-    fusedQueue = Queue()
-
-    feederFunc(inTRCData, inertialFPS, inertialQueue, opticalQueue, opticalSkipFactor, numFrames)
-    fuser(inertialQueue, opticalQueue, fusedQueue, opticalFPS, occlusionDuration, occlusionNumber, markers, amplitude, frequency, verticalShift, numFrames)
-    writeToOutfile( fusedQueue, inFilePath, outFilePath )
-    
-    avgError, standardDevation = produceOpticalComparisonStats( inTRCData, outFilePath, numFrames, len(allMarkerNames), opticalSkipFactor )
+    profilePath = 'profile.json'        # stage summary
+    tracePath = 'profile_trace.json'    # Chrome trace (chrome://tracing or ui.perfetto.dev)
+    markerGroupsPath = None             # batch engine only: group definition file (e.g. 'marker_groups.json'), occludes occlusionNumber whole body segments at a time. None occludes single markers.
+
+    profiler = Profiler(profile)
+    if useBatchEngine and not (realTime or liveStats):
+        stats, _ = runPipeline(inFilePath, amplitude, frequency, verticalShift, occlusionNumber, occlusionDuration, opticalSkipFactor,
+                               outFilePath=outFilePath if writeOutput else None, accumulateDrift=accumulateDrift, profiler=profiler,
+                               useKernel=useKernel, noRepeatGroups=noRepeatGroups, markerGroups=markerGroupsPath)
+        avgError, standardDevation = stats['avgError'], stats['stdError']
+        print('error by axis (x, y, z):', stats['axisAvgError'])
+        print('occluded error:', stats['occludedAvgError'], 'visible error:', stats['visibleAvgError'])
+    else:
+        inTRCData = TRCData()
+        inTRCData.load(inFilePath)
+
+        report = runStreamingPipeline(inTRCData, inFilePath, outFilePath, opticalSkipFactor, occlusionDuration, occlusionNumber, amplitude, frequency, verticalShift,
+                                      realTime=realTime, liveStats=liveStats, onStatsSnapshot=print, profile=profile)
+        if 'realTime' in report:
+            print(report['realTime'])
+        if 'profile' in report:
+            profiler = report['profile']
+
+        with profiler.stage('produceOpticalComparisonStats', inTRCData['NumFrames']):
+            avgError, standardDevation = produceOpticalComparisonStats( inTRCData, outFilePath, inTRCData['NumFrames'], len(inTRCData['Markers']), opticalSkipFactor )
     
     print(avgError)
     print(standardDevation)
 
+    if profile:
+        print(profiler.summary())
+        profiler.writeJSON(profilePath)
+        profiler.writeChromeTrace(tracePath)
+
 
 
 
@@ -307,7 +519,7 @@ if __name__ == '__main__':
 
 
 
-# old new occluder
+# old new occluder  (now the noRepeat policy of kernels.runKernelSimulation)
             # oldGroupIndexes = oclGroupIndexes       # seed new random group, all new members (compared to previous random group)
             # oclGroupIndexes = []
             # for _ in range( 0, occlusionNumber ):
@@ -0,0 +1,234 @@
+import numpy as np
+
+from engine import exactRound
+
+
+# Error statistics of a fused capture against the optical ground truth, computed straight from the arrays
+# (see engine.py for the layout). Errors are taken on optical frames only, rounded to 4 decimals like
+# produceOpticalComparisonStats always has.
+
+AXES = ['x', 'y', 'z']
+
+
+def opticalErrors(readings: np.ndarray, fused: np.ndarray, opticalSkipFactor: int):
+# Absolute error of every marker on every optical frame, shape (optical frames, markers, 3).
+
+    return exactRound(np.abs(readings[::opticalSkipFactor] - fused[::opticalSkipFactor]), 4)
+
+def opticalComparisonStats(readings: np.ndarray, fused: np.ndarray, opticalSkipFactor: int):
+# In memory equivalent of produceOpticalComparisonStats: x-axis error on every optical frame, without writing and reloading the output file.
+
+    errorValues = exactRound(np.abs(readings[::opticalSkipFactor, :, 0] - fused[::opticalSkipFactor, :, 0]), 4).ravel()  # frame by frame, marker by marker, like the original loop
+
+    return np.average(errorValues), np.std(errorValues)
+
+def _averageAndStd(errors: np.ndarray, axis=0):
+# Mean and std along axis, nan (instead of a warning) when there is nothing to average.
+
+    if errors.shape[axis] == 0:
+        empty = np.full(np.delete(errors.shape, axis), np.nan)
+        return empty, empty.copy()
+    return errors.mean(axis=axis), errors.std(axis=axis)
+
+def comparisonStats(readings: np.ndarray, fused: np.ndarray, mask: np.ndarray, opticalSkipFactor: int):
+    # Purpose:
+    # Full breakdown of the optical comparison error, vectorized over frames and markers.
+    # Parameters:
+    # readings: optical ground truth.  fused: simulated hybrid output.  mask: occlusion mask from engine.buildOcclusionMask.
+    # Returns a dict:
+    # avgError, stdError:                x-axis error over all optical frames, same numbers as produceOpticalComparisonStats
+    # axisAvgError, axisStdError:        shape (3,), per axis
+    # markerAvgError, markerStdError:    shape (markers, 3), per marker and axis, in header['Markers'] order
+    # occludedAvgError, occludedStdError, occludedCount:  shape (3,), readings that were occluded on optical frames
+    # visibleAvgError, visibleStdError, visibleCount:     shape (3,), readings that were visible on optical frames
+
+    errors = opticalErrors(readings, fused, opticalSkipFactor)
+    occluded = mask[::opticalSkipFactor]
+
+    avgError, stdError = opticalComparisonStats(readings, fused, opticalSkipFactor)
+    axisAvgError, axisStdError = _averageAndStd(errors.reshape(-1, 3))
+    markerAvgError, markerStdError = _averageAndStd(errors)
+    occludedAvgError, occludedStdError = _averageAndStd(errors[occluded])
+    visibleAvgError, visibleStdError = _averageAndStd(errors[~occluded])
+
+    return {
+        'avgError': float(avgError), 'stdError': float(stdError),
+        'axisAvgError': axisAvgError, 'axisStdError': axisStdError,
+        'markerAvgError': markerAvgError, 'markerStdError': markerStdError,
+        'occludedAvgError': occludedAvgError, 'occludedStdError': occludedStdError, 'occludedCount': int(np.count_nonzero(occluded)),
+        'visibleAvgError': visibleAvgError, 'visibleStdError': visibleStdError, 'visibleCount': int(occluded.size - np.count_nonzero(occluded)),
+    }
+
+def _moments(values: np.ndarray, axis=0):
+# count, mean and sum of squared deviations along axis.
+
+    count = values.shape[axis]
+    if count == 0:
+        zeros = np.zeros(np.delete(values.shape, axis))
+        return 0, zeros, zeros.copy()
+    mean = values.mean(axis=axis)
+    return count, mean, np.square(values - np.expand_dims(mean, axis)).sum(axis=axis)
+
+class ChunkedComparisonStats:
+    # Purpose:
+    # comparisonStats() for a capture processed one window of frames at a time (pipeline.runChunkedPipeline). Every
+    # breakdown keeps only a count, mean and sum of squared deviations, merged window by window (Chan et al.), so memory
+    # depends on the number of markers, not on the length of the capture.
+    # The results match comparisonStats() on the whole capture up to floating point summation order.
+    # Parameters:
+    # opticalSkipFactor: as in comparisonStats. Windows must be passed in order, optical frames follow the capture's frame numbers.
+
+    def __init__(self, numMarkers: int, opticalSkipFactor: int):
+
+        self.opticalSkipFactor = opticalSkipFactor
+        self.framesSeen = 0
+        self._breakdowns = {name: [0, np.zeros(shape), np.zeros(shape)] for name, shape in
+                            [('x', ()), ('axis', (3,)), ('marker', (numMarkers, 3)), ('occluded', (3,)), ('visible', (3,))]}
+
+    def _merge(self, name: str, count: int, mean: np.ndarray, m2: np.ndarray):
+
+        if count == 0:
+            return
+        moments = self._breakdowns[name]
+        total = moments[0] + count
+        delta = mean - moments[1]
+        moments[1] = moments[1] + delta * count / total
+        moments[2] = moments[2] + m2 + delta * delta * moments[0] * count / total
+        moments[0] = total
+
+    def update(self, readings: np.ndarray, fused: np.ndarray, mask: np.ndarray):
+    # Adds the next window: optical ground truth, fused output and occlusion mask of the same frames.
+
+        firstOptical = (-self.framesSeen) % self.opticalSkipFactor
+        errors = opticalErrors(readings[firstOptical:], fused[firstOptical:], self.opticalSkipFactor)
+        occluded = mask[firstOptical::self.opticalSkipFactor]
+        self.framesSeen += len(readings)
+
+        self._merge('x', *_moments(errors[:, :, 0].ravel()))
+        self._merge('axis', *_moments(errors.reshape(-1, 3)))
+        self._merge('marker', *_moments(errors))
+        self._merge('occluded', *_moments(errors[occluded]))
+        self._merge('visible', *_moments(errors[~occluded]))
+
+    def _averageAndStd(self, name: str):
+
+        count, mean, m2 = self._breakdowns[name]
+        if count == 0:
+            return np.full(np.shape(mean), np.nan), np.full(np.shape(mean), np.nan)
+        return mean, np.sqrt(m2 / count)
+
+    def result(self):
+    # Same dict as comparisonStats().
+
+        avgError, stdError = self._averageAndStd('x')
+        axisAvgError, axisStdError = self._averageAndStd('axis')
+        markerAvgError, markerStdError = self._averageAndStd('marker')
+        occludedAvgError, occludedStdError = self._averageAndStd('occluded')
+        visibleAvgError, visibleStdError = self._averageAndStd('visible')
+
+        return {
+            'avgError': float(avgError), 'stdError': float(stdError),
+            'axisAvgError': axisAvgError, 'axisStdError': axisStdError,
+            'markerAvgError': markerAvgError, 'markerStdError': markerStdError,
+            'occludedAvgError': occludedAvgError, 'occludedStdError': occludedStdError, 'occludedCount': self._breakdowns['occluded'][0],
+            'visibleAvgError': visibleAvgError, 'visibleStdError': visibleStdError, 'visibleCount': self._breakdowns['visible'][0],
+        }
+
+class OnlineErrorStats:
+    # Purpose:
+    # Streaming accumulator for non-negative error values (unbounded sessions, live mode). Memory is fixed no matter how
+    # many values go through it:
+    # mean and variance: Welford, merged batch by batch (Chan et al.) so every update is a few numpy calls.
+    # min, max: running.
+    # percentiles: fixed size log-bucket sketch. Bucket k covers (gamma^(k-1), gamma^k], so any estimate is within
+    #              relativeAccuracy of a true value. Values under minValue (and 0) share one bucket, values over maxValue
+    #              land in the last one.
+
+    def __init__(self, relativeAccuracy: float = 0.01, minValue: float = 1e-6, maxValue: float = 1e6):
+
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self._logGamma = np.log(self.gamma)
+        self.minValue = minValue
+        self._minKey = int(np.ceil(np.log(minValue) / self._logGamma))
+        numBuckets = int(np.ceil(np.log(maxValue) / self._logGamma)) - self._minKey + 1
+        self.buckets = np.zeros(numBuckets + 1, dtype=np.int64)    # [0] holds values under minValue
+
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+    # Adds a batch of values (any shape). nan values are skipped.
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        batchCount = len(values)
+        if batchCount == 0:
+            return
+
+        batchMean = values.mean()
+        batchM2 = np.square(values - batchMean).sum()
+        total = self.count + batchCount
+        delta = batchMean - self.mean
+        self.mean += delta * batchCount / total
+        self._m2 += batchM2 + delta * delta * self.count * batchCount / total
+        self.count = total
+
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        keys = np.zeros(batchCount, dtype=np.int64)
+        large = values >= self.minValue
+        keys[large] = np.ceil(np.log(values[large]) / self._logGamma).astype(np.int64) - self._minKey + 1
+        np.minimum(keys, len(self.buckets) - 1, out=keys)
+        self.buckets += np.bincount(keys, minlength=len(self.buckets))
+
+    def merge(self, other: 'OnlineErrorStats'):
+    # Folds another accumulator with the same sketch settings into this one (e.g. one per worker).
+
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self._m2 += other._m2 + delta * delta * self.count * other.count / total
+        self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets += other.buckets
+
+    def variance(self):
+    # Population variance, same definition as np.std.
+
+        return self._m2 / self.count if self.count else np.nan
+
+    def percentile(self, q: float):
+    # Approximate q-th percentile (0-100) from the sketch.
+
+        if self.count == 0:
+            return np.nan
+
+        rank = q / 100 * (self.count - 1)
+        bucket = int(np.searchsorted(np.cumsum(self.buckets), rank, side='right'))
+        if bucket == 0:
+            estimate = 0.0
+        else:
+            upper = self.gamma ** (bucket - 1 + self._minKey)
+            estimate = 2 * upper / (self.gamma + 1)
+        return float(min(max(estimate, self.min), self.max))
+
+    def snapshot(self):
+    # Current state as a plain dict, safe to call at any time and to send over a queue.
+
+        return {
+            'count': self.count,
+            'avgError': float(self.mean) if self.count else np.nan,
+            'stdError': float(np.sqrt(self.variance())),
+            'minError': float(self.min) if self.count else np.nan,
+            'maxError': float(self.max) if self.count else np.nan,
+            'p50Error': self.percentile(50),
+            'p95Error': self.percentile(95),
+            'p99Error': self.percentile(99),
+        }
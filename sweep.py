@@ -0,0 +1,135 @@
+import argparse
+import csv
+import itertools
+import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import freeze_support, shared_memory
+
+import numpy as np
+
+from engine import buildOcclusionMask, batchFuser
+from stats import opticalComparisonStats
+from trcio import loadTRCCached
+
+
+# Parameter sweep: runs every combination of a parameter grid against one input TRC.
+# The TRC is parsed once by the parent. Its readings are copied into shared memory and every worker maps the same pages
+# read-only, so nothing but the small parameter dict is pickled per combination.
+
+SWEEP_PARAMETERS = ['amplitude', 'frequency', 'verticalShift', 'occlusionNumber', 'occlusionDuration', 'opticalSkipFactor']
+# type and default of every simulation parameter, the defaults are the values of the simulation.py __main__ block.
+# Shared by the command lines of sweep.py, batch.py, montecarlo.py and the benchmark runs.
+PARAMETER_TYPES = {'amplitude': float, 'frequency': float, 'verticalShift': float, 'occlusionNumber': int, 'occlusionDuration': float,
+                   'opticalSkipFactor': int}
+PARAMETER_DEFAULTS = {'amplitude': 89.2, 'frequency': 0.9, 'verticalShift': 89.2, 'occlusionNumber': 25, 'occlusionDuration': 10,
+                      'opticalSkipFactor': 4}
+
+# worker side state, filled in once per worker process by _initWorker
+_workerTimes = None
+_workerReadings = None
+_workerDataRate = None
+_workerSharedMemory = None
+
+
+def addParameterArguments(parser: argparse.ArgumentParser, grid: bool = False):
+# Adds a --<name> option per simulation parameter (SWEEP_PARAMETERS) to parser, defaulting to PARAMETER_DEFAULTS.
+# grid: every option takes a list of values (defaulting to a one value list), for parameter grids.
+
+    for name in SWEEP_PARAMETERS:
+        if grid:
+            parser.add_argument('--' + name, type=PARAMETER_TYPES[name], nargs='+', default=[PARAMETER_DEFAULTS[name]])
+        else:
+            parser.add_argument('--' + name, type=PARAMETER_TYPES[name], default=PARAMETER_DEFAULTS[name])
+    return
+
+def parameterGrid(grid: dict):
+# Expands {'amplitude': [..], 'frequency': [..], ...} into a list of dicts, one per combination.
+
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def _initWorker(sharedName: str, shape: tuple, times: np.ndarray, dataRate: float):
+# Attaches a worker process to the shared readings array.
+
+    global _workerTimes, _workerReadings, _workerDataRate, _workerSharedMemory
+
+    _workerSharedMemory = shared_memory.SharedMemory(name=sharedName)
+    _workerReadings = np.ndarray(shape, dtype=np.float64, buffer=_workerSharedMemory.buf)
+    _workerReadings.flags.writeable = False
+    _workerTimes = times
+    _workerDataRate = dataRate
+
+def runCombination(params: dict, seed=None):
+# Runs one combination against the worker's shared readings and returns the params together with the error stats.
+# A seed makes every combination reproducible no matter which worker picks it up.
+
+    if seed is not None:
+        random.seed(seed)
+
+    numFrames, numMarkers = _workerReadings.shape[0], _workerReadings.shape[1]
+    opticalSkipFactor = int(params['opticalSkipFactor'])
+    opticalFPS = _workerDataRate / opticalSkipFactor
+
+    mask = buildOcclusionMask(numFrames, numMarkers, opticalFPS, params['occlusionDuration'], int(params['occlusionNumber']), opticalSkipFactor)
+    fused = batchFuser(_workerTimes, _workerReadings, mask, params['amplitude'], params['frequency'], params['verticalShift'])
+    avgError, standardDeviation = opticalComparisonStats(_workerReadings, fused, opticalSkipFactor)
+
+    result = dict(params)
+    result['avgError'] = float(avgError)
+    result['stdError'] = float(standardDeviation)
+    return result
+
+def runSweep(inFilePath, grid: dict, workers=None, seed=None):
+    # Purpose:
+    # Runs every combination of grid against inFilePath across a process pool.
+    # Parameters:
+    # grid: dict of parameter name -> list of values, keys from SWEEP_PARAMETERS.
+    # workers: number of worker processes (None = one per core).  seed: random seed applied to every combination, None for unseeded runs.
+    # Returns a list of result dicts in the same order as parameterGrid(grid).
+
+    header, times, readings = loadTRCCached(inFilePath)
+    dataRate = header['DataRate']
+
+    combinations = parameterGrid(grid)
+
+    sharedReadings = shared_memory.SharedMemory(create=True, size=readings.nbytes)
+    try:
+        shape = readings.shape
+        np.ndarray(shape, dtype=np.float64, buffer=sharedReadings.buf)[:] = readings
+        del readings
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker,
+                                 initargs=(sharedReadings.name, shape, times, dataRate)) as executor:
+            results = list(executor.map(runCombination, combinations, itertools.repeat(seed)))
+    finally:
+        sharedReadings.close()
+        sharedReadings.unlink()
+
+    return results
+
+def writeResultsTable(results: list, outFilePath):
+# Writes sweep results as a CSV table, one row per combination.
+
+    with open(outFilePath, 'w', newline='') as outputFile:
+        writer = csv.DictWriter(outputFile, fieldnames=SWEEP_PARAMETERS + ['avgError', 'stdError'])
+        writer.writeheader()
+        writer.writerows(results)
+    return
+
+if __name__ == '__main__':
+    freeze_support()
+
+    parser = argparse.ArgumentParser(description='Run the drift simulation over a grid of parameters and collect the optical comparison stats.')
+    parser.add_argument('inFilePath', help='input TRC file')
+    parser.add_argument('--out', default='sweep_results.csv', help='CSV file for the results table')
+    addParameterArguments(parser, grid=True)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--seed', type=int, default=None, help='seed applied to every combination')
+    args = parser.parse_args()
+
+    grid = {name: getattr(args, name) for name in SWEEP_PARAMETERS}
+    results = runSweep(args.inFilePath, grid, workers=args.workers, seed=args.seed)
+    writeResultsTable(results, args.out)
+
+    for result in results:
+        print(result)
@@ -0,0 +1,121 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+import kernels
+from engine import runBatchSimulation
+from montecarlo import TrialScheduler
+from simulation import createMarkerObjectList, drifter, occluder
+
+
+# Checks the kernel backend (compiled when numba is installed, plain Python otherwise) against the reference per-frame
+# occluder()/drifter() and against the seeded batch engine.
+
+DATA_RATE = 120.0
+AMPLITUDE, FREQUENCY, VERTICAL_SHIFT = 89.2, 0.9, 89.2
+
+
+@pytest.fixture
+def capture():
+# 600 frames of 12 markers, readings with 5 decimals like a TRC file.
+
+    rng = np.random.default_rng(0)
+    times = np.round(np.arange(600) / DATA_RATE, 5)
+    readings = np.round(rng.uniform(-1000, 1000, (600, 12, 3)), 5)
+    return times, readings
+
+def opticalGroups(mask: np.ndarray, opticalSkipFactor: int):
+# Occluded marker set of every optical frame.
+
+    return [frozenset(np.flatnonzero(row)) for row in mask[::opticalSkipFactor]]
+
+def groupStarts(groups: list):
+    return [index for index in range(len(groups)) if index == 0 or groups[index] != groups[index - 1]]
+
+def test_fused_matches_reference_drifter(capture):
+    times, readings = capture
+    fused, mask = kernels.runKernelSimulation(times, readings, DATA_RATE, 4, 0.5, 5, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, seed=1)
+
+    markers = list(range(readings.shape[1]))
+    for frame in range(len(times)):
+        inertialFrame = (times[frame], [tuple(reading) for reading in readings[frame]])
+        opticalFrame = (times[frame], ['N/A' if mask[frame, marker] else tuple(readings[frame, marker]) for marker in markers])
+        expected = drifter(inertialFrame, opticalFrame, markers, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT)
+        assert np.array_equal(np.array(expected[1], dtype=np.float64), fused[frame])
+
+@pytest.mark.parametrize('opticalSkipFactor, occlusionDuration', [(4, 0.5), (3, 0.25), (1, 0.1), (4, 0)])
+def test_group_schedule_matches_reference_occluder(capture, opticalSkipFactor, occlusionDuration):
+    times, readings = capture
+    numMarkers = readings.shape[1]
+    _, mask = kernels.runKernelSimulation(times, readings, DATA_RATE, opticalSkipFactor, occlusionDuration, 5, AMPLITUDE, FREQUENCY,
+                                          VERTICAL_SHIFT, seed=2)
+
+    random.seed(2)
+    opticalFPS = DATA_RATE / opticalSkipFactor
+    markers = createMarkerObjectList(range(numMarkers))
+    reference = []
+    for frame in range(0, len(times), opticalSkipFactor):
+        opticalFrame = (times[frame], [tuple(reading) for reading in readings[frame]])
+        occluded = occluder(opticalFrame, opticalFPS, occlusionDuration, 5, markers)
+        reference.append(frozenset(marker for marker in range(numMarkers) if occluded[1][marker] == 'N/A'))
+
+    groups = opticalGroups(mask, opticalSkipFactor)
+    assert {len(group) for group in groups} == {5}
+    assert groupStarts(groups) == groupStarts(reference)      # groups change on the same optical frames as occluder()'s
+
+@pytest.mark.parametrize('accumulateDrift', [False, True])
+@pytest.mark.parametrize('opticalSkipFactor, occlusionDuration, occlusionNumber', [(4, 0.5, 5), (3, 0.25, 2), (1, 0.1, 12), (5, 0, 3), (4, 1, 0)])
+def test_matches_seeded_batch_engine(capture, accumulateDrift, opticalSkipFactor, occlusionDuration, occlusionNumber):
+    times, readings = capture
+    numMarkers = readings.shape[1]
+    scheduler = TrialScheduler(numMarkers, occlusionNumber, int(DATA_RATE / opticalSkipFactor * occlusionDuration), 7)
+
+    expectedFused, expectedMask = runBatchSimulation(times, readings, DATA_RATE, opticalSkipFactor, occlusionDuration, occlusionNumber,
+                                                     AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, scheduler, accumulateDrift=accumulateDrift)
+    fused, mask = kernels.runKernelSimulation(times, readings, DATA_RATE, opticalSkipFactor, occlusionDuration, occlusionNumber,
+                                              AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, seed=7, accumulateDrift=accumulateDrift)
+
+    assert np.array_equal(mask, expectedMask)
+    assert np.array_equal(fused, expectedFused)
+
+def test_no_repeat_groups_are_disjoint(capture):
+    times, readings = capture
+    _, mask = kernels.runKernelSimulation(times, readings, DATA_RATE, 4, 0.1, 6, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, seed=3, noRepeat=True)
+
+    groups = opticalGroups(mask, 4)
+    distinct = [groups[index] for index in groupStarts(groups)]
+    assert len(distinct) > 10
+    assert all(len(group) == 6 for group in distinct)
+    assert all(not (previous & group) for previous, group in zip(distinct, distinct[1:]))
+
+def test_no_repeat_needs_enough_units(capture):
+    times, readings = capture
+    with pytest.raises(ValueError):
+        kernels.runKernelSimulation(times, readings, DATA_RATE, 4, 0.1, 7, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, seed=3, noRepeat=True)
+
+@pytest.mark.parametrize('noRepeat', [False, True])
+def test_group_mode_occludes_whole_groups(capture, noRepeat):
+    times, readings = capture
+    markerGroups = [[0, 1, 2], [3, 4], [5, 6, 7, 8], [9], [10, 11]]
+    fused, mask = kernels.runKernelSimulation(times, readings, DATA_RATE, 4, 0.1, 2, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, seed=4,
+                                              groups=markerGroups, noRepeat=noRepeat)
+
+    unions = {frozenset(itertools.chain(*(markerGroups[group] for group in chosen))): chosen
+              for chosen in itertools.combinations(range(len(markerGroups)), 2)}
+    groups = opticalGroups(mask, 4)
+    assert all(group in unions for group in groups)
+    assert mask[np.arange(len(times)) % 4 != 0].all()      # inertial only frames are always drifted
+
+    if noRepeat:
+        chosen = [set(unions[groups[index]]) for index in groupStarts(groups)]
+        assert all(not (previous & current) for previous, current in zip(chosen, chosen[1:]))
+
+    visible = ~mask
+    assert np.array_equal(fused[visible], readings[visible])
+
+def test_occlusion_number_larger_than_units(capture):
+    times, readings = capture
+    with pytest.raises(ValueError):
+        kernels.runKernelSimulation(times, readings, DATA_RATE, 4, 0.5, 3, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, seed=1, groups=[[0], [1]])
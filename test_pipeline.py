@@ -0,0 +1,69 @@
+import random
+
+import numpy as np
+import pytest
+
+from benchmark import writeSyntheticTRC
+from pipeline import runChunkedPipeline, runPipeline
+from simulation import createMarkerObjectList, drifter, occluder
+from trcio import readTRC
+
+
+# Checks the batch pipeline against the reference per-frame occluder()/drifter() on a small synthetic capture, and the
+# chunked pipeline against the batch pipeline.
+
+DATA_RATE = 120.0
+AMPLITUDE, FREQUENCY, VERTICAL_SHIFT = 89.2, 0.9, 89.2
+
+
+@pytest.fixture
+def capturePath(tmp_path):
+# 600 frames of 12 markers.
+
+    filePath = str(tmp_path / 'capture.trc')
+    writeSyntheticTRC(filePath, numMarkers=12, numFrames=600, dataRate=DATA_RATE)
+    return filePath
+
+def referenceFusion(filePath, opticalSkipFactor: int, occlusionDuration: float, occlusionNumber: int, seed):
+# Fused readings of the per-frame reference: every optical frame goes through occluder(), every frame through drifter().
+
+    header, times, readings = readTRC(filePath)
+    opticalFPS = header['DataRate'] / opticalSkipFactor
+    markers = createMarkerObjectList(header['Markers'])
+    markerIndexes = list(range(len(markers)))
+
+    random.seed(seed)
+    fused = []
+    for frame in range(len(times)):
+        inertialFrame = (times[frame], [tuple(reading) for reading in readings[frame]])
+        if frame % opticalSkipFactor == 0:
+            opticalFrame = occluder((times[frame], [tuple(reading) for reading in readings[frame]]), opticalFPS, occlusionDuration,
+                                    occlusionNumber, markers)
+        else:
+            opticalFrame = (times[frame], ['N/A'] * len(markers))
+        fused.append(drifter(inertialFrame, opticalFrame, markerIndexes, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT)[1])
+
+    return np.array(fused, dtype=np.float64)
+
+@pytest.mark.parametrize('occlusionDuration, occlusionNumber', [(0.5, 5), (0.1, 3), (1, 12), (0, 4)])
+def test_matches_reference_occluder_and_drifter(capturePath, occlusionDuration, occlusionNumber):
+    expected = referenceFusion(capturePath, 4, occlusionDuration, occlusionNumber, seed=5)
+    _, fused = runPipeline(capturePath, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, occlusionNumber, occlusionDuration, 4, seed=5,
+                           useCache=False)
+
+    assert np.array_equal(fused, expected)
+
+@pytest.mark.parametrize('chunkFrames', [1, 7, 256, 5000])
+@pytest.mark.parametrize('options', [{}, {'useScheduler': True}, {'accumulateDrift': True}, {'useScheduler': True, 'accumulateDrift': True}])
+def test_chunked_matches_whole_capture(capturePath, tmp_path, chunkFrames, options):
+    wholePath, chunkedPath = str(tmp_path / 'whole.trc'), str(tmp_path / 'chunked.trc')
+    stats, _ = runPipeline(capturePath, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, 5, 0.5, 3, outFilePath=wholePath, seed=9, useCache=False, **options)
+    chunkedStats = runChunkedPipeline(capturePath, AMPLITUDE, FREQUENCY, VERTICAL_SHIFT, 5, 0.5, 3, outFilePath=chunkedPath, seed=9,
+                                      chunkFrames=chunkFrames, **options)
+
+    with open(wholePath, 'rb') as wholeFile, open(chunkedPath, 'rb') as chunkedFile:
+        assert wholeFile.read() == chunkedFile.read()
+    assert stats.keys() == chunkedStats.keys()
+    for name in stats:
+        assert np.allclose(np.asarray(chunkedStats[name], dtype=np.float64), np.asarray(stats[name], dtype=np.float64),
+                           rtol=0, atol=1e-9, equal_nan=True), name
@@ -0,0 +1,282 @@
+import glob
+import hashlib
+import itertools
+import json
+import os
+import re
+
+import numpy as np
+
+from engine import exactRound
+
+
+# Fast TRC reading and writing straight from and to NumPy arrays, without going through trc.TRCData.
+# Same array layout as engine.py:
+# times:    shape (frames,)
+# readings: shape (frames, markers, 3)
+# header:   dict with the header keys of the file (DataRate, NumFrames, NumMarkers, ...), 'Markers' (marker names in column order)
+#           and 'HeaderLines', the header text so outputs can copy it without reopening the input. Its lines end in '\n'
+#           whatever the input used, like the data rows written by formatTRCBlock, so an output never mixes line endings.
+
+HEADER_LINE_COUNT = 6        # PathFileType line, header keys, header values, marker names, X1/Y1/Z1 line, blank line
+DEFAULT_PRECISION = 5        # decimals written for readings. TRC files are normally written with 5.
+TIME_PRECISION = 5           # decimals written for the time column
+BLOCK_FRAMES = 1024          # frames formatted per write call
+CACHE_DIR_NAME = '.trc_cache'  # default cache folder, created next to the source TRC
+CHUNK_FRAMES = 16384         # frames per window read by readTRCChunks
+
+_HEADER_TYPES = {'NumFrames': int, 'NumMarkers': int, 'OrigDataStartFrame': int, 'OrigNumFrames': int, 'Units': str}
+
+
+def _newlineLines(lines: list):
+# lines with their line endings ('\r\n', '\n') replaced by '\n'.
+
+    return [line.rstrip('\r\n') + '\n' if line else line for line in lines]
+
+def parseTRCHeader(headerLines: list):
+# Parses the 6 raw header lines of a TRC file into a header dict.
+
+    header = {'HeaderLines': _newlineLines(headerLines)}
+
+    sections = headerLines[0].split(maxsplit=3)
+    header['DataFormat'] = sections[2] if len(sections) > 2 else '(X/Y/Z)'
+
+    for key, value in zip(headerLines[1].split(), headerLines[2].split()):
+        header[key] = _HEADER_TYPES.get(key, float)(value)
+
+    header['Markers'] = headerLines[3].split()[2:]   # skip 'Frame#' and 'Time'
+    return header
+
+def readTRCHeader(filePath):
+# Reads only the header of a TRC file.
+
+    with open(filePath, 'r', newline='') as inFile:
+        headerLines = [inFile.readline() for _ in range(HEADER_LINE_COUNT)]
+
+    return parseTRCHeader(headerLines)
+
+def parseTRCBody(body: str, numMarkers: int):
+# Parses the data rows of a TRC file into times and readings.
+# Fast path: the whole body is parsed by numpy in one call. Blank fields (missing readings) are skipped by that parse, so
+# it is only used when it yields exactly one full row per data line. Otherwise falls back to parsing row by row, with
+# blanks read as nan.
+
+    rowLength = 2 + 3 * numMarkers
+    lines = [line for line in body.splitlines() if line.strip()]
+    values = np.fromstring(body, sep=' ')
+
+    if len(values) != len(lines) * rowLength:
+        rows = []
+        for line in lines:
+            fields = line.rstrip('\r\n').split('\t')[:rowLength]
+            fields += [''] * (rowLength - len(fields))
+            rows.append([float(field) if field.strip() else np.nan for field in fields])
+        values = np.array(rows, dtype=np.float64)
+
+    values = values.reshape(-1, rowLength)
+    times = values[:, 1].copy()
+    readings = values[:, 2:].reshape(-1, numMarkers, 3)
+
+    return times, readings
+
+def readTRC(filePath):
+# Reads a whole TRC file. Returns header, times, readings.
+
+    with open(filePath, 'r', newline='') as inFile:
+        headerLines = [inFile.readline() for _ in range(HEADER_LINE_COUNT)]
+        body = inFile.read()
+
+    header = parseTRCHeader(headerLines)
+    times, readings = parseTRCBody(body, len(header['Markers']))
+
+    return header, times, readings
+
+def readTRCChunks(filePath, chunkFrames: int = CHUNK_FRAMES):
+# Reads a TRC file one window of chunkFrames frames at a time, for captures that do not fit in memory.
+# Yields (times, readings) per window, in file order. The header comes from readTRCHeader.
+
+    with open(filePath, 'r', newline='') as inFile:
+        headerLines = [inFile.readline() for _ in range(HEADER_LINE_COUNT)]
+        numMarkers = len(parseTRCHeader(headerLines)['Markers'])
+
+        while True:
+            lines = list(itertools.islice(inFile, chunkFrames))
+            if not lines:
+                break
+            times, readings = parseTRCBody(''.join(lines), numMarkers)
+            if len(times):
+                yield times, readings
+    return
+
+_EXACT_INTEGER_LIMIT = 2.0 ** 53   # scaled values past this lose digits as integers and go through the string formatting fallback
+_POWERS_OF_TEN = 10 ** np.arange(17, dtype=np.int64)
+
+
+def _narrowest(integers: np.ndarray):
+# Non-negative integers as uint32 when they fit, integer division is a lot cheaper on it than on int64.
+
+    if integers.max(initial=0) < 2 ** 32:
+        return integers.astype(np.uint32)
+    return integers
+
+def _fixedPointFields(values: np.ndarray, precision: int):
+# Builds the text of '%.<precision>f\t' for every value as a (values, fieldWidth) byte matrix, right aligned and padded with 0 bytes.
+# Digits come from the correctly rounded scaled value (exactRound), so the text is the same as Python's % formatting.
+
+    scale = 10 ** precision
+    digits = np.rint(exactRound(np.abs(values), precision) * scale).astype(np.int64)
+    integerPart = digits // scale
+    integerDigits = np.maximum(np.searchsorted(_POWERS_OF_TEN, integerPart, side='right'), 1)
+    integerWidth = 1 + int(integerDigits.max(initial=1))        # one extra column for the sign
+
+    fractionWidth = precision + 1 if precision > 0 else 0
+    fields = np.zeros((len(values), integerWidth + fractionWidth + 1), dtype=np.uint8)
+
+    remaining = _narrowest(integerPart)
+    for position in range(integerWidth - 1):
+        remaining, digit = np.divmod(remaining, 10)
+        fields[:, integerWidth - 1 - position] = np.where(position < integerDigits, ord('0') + digit, 0)
+
+    negative = np.flatnonzero(np.signbit(values))
+    fields[negative, integerWidth - 1 - integerDigits[negative]] = ord('-')
+
+    if precision > 0:
+        remaining = _narrowest(digits % scale)
+        fields[:, integerWidth] = ord('.')
+        for position in range(precision):
+            remaining, digit = np.divmod(remaining, 10)
+            fields[:, integerWidth + precision - position] = ord('0') + digit
+
+    fields[:, -1] = ord('\t')
+    return fields
+
+def formatTRCBlock(firstFrameNumber: int, times: np.ndarray, readings: np.ndarray, precision: int = DEFAULT_PRECISION):
+# Formats a block of frames as TRC data rows.
+# Rows keep the layout writeToOutfile has always used: frame number, time, readings, each followed by a tab.
+# The text is assembled as one byte matrix and the padding squeezed out, instead of formatting every number on its own.
+
+    numFrames = len(times)
+    times = np.asarray(times, dtype=np.float64)
+    readings = np.asarray(readings, dtype=np.float64).reshape(numFrames, -1)
+    frameNumbers = np.arange(firstFrameNumber, firstFrameNumber + numFrames, dtype=np.float64)
+
+    inRange = (np.all(np.abs(readings) < _EXACT_INTEGER_LIMIT / 10 ** precision) and
+               np.all(np.abs(times) < _EXACT_INTEGER_LIMIT / 10 ** TIME_PRECISION))     # also False for nan and inf
+    if not inRange:
+        rowFormat = '%d\t%.' + str(TIME_PRECISION) + 'f\t' + ('%.' + str(precision) + 'f\t') * readings.shape[1] + '\n'
+        columns = np.column_stack([frameNumbers, times, readings])
+        return (rowFormat * numFrames) % tuple(columns.ravel().tolist())
+
+    text = np.concatenate([
+        _fixedPointFields(frameNumbers, 0),
+        _fixedPointFields(times, TIME_PRECISION),
+        _fixedPointFields(readings.ravel(), precision).reshape(numFrames, -1),
+        np.full((numFrames, 1), ord('\n'), dtype=np.uint8),
+    ], axis=1)
+
+    return text[text != 0].tobytes().decode('ascii')
+
+def writeTRCBlock(outputFile, firstFrameNumber: int, times: np.ndarray, readings: np.ndarray, precision: int = DEFAULT_PRECISION):
+# Appends frames to an open TRC file, BLOCK_FRAMES frames per write call.
+
+    for start in range(0, len(times), BLOCK_FRAMES):
+        stop = start + BLOCK_FRAMES
+        outputFile.write(formatTRCBlock(firstFrameNumber + start, times[start:stop], readings[start:stop], precision))
+    return
+
+def writeTRC(filePath, headerLines: list, times: np.ndarray, readings: np.ndarray, precision: int = DEFAULT_PRECISION):
+# Writes a whole TRC file: the given header lines (normally header['HeaderLines'] of the input), then every frame.
+
+    with open(filePath, 'w', newline='') as outputFile:
+        outputFile.writelines(headerLines)
+        writeTRCBlock(outputFile, 1, times, readings, precision)
+    return
+
+def _sourceKey(filePath, keyByHash: bool):
+# Identifies one version of a source file: size and modification time, or the content hash if keyByHash.
+
+    if keyByHash:
+        digest = hashlib.sha256()
+        with open(filePath, 'rb') as inFile:
+            for block in iter(lambda: inFile.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()[:16]
+
+    stat = os.stat(filePath)
+    return hashlib.sha256(('%s|%d|%d' % (os.path.abspath(filePath), stat.st_size, stat.st_mtime_ns)).encode()).hexdigest()[:16]
+
+def _saveAtomically(path, save):
+# Writes path through save(binary file) to a temporary file first, so workers racing on the same cache never map a half
+# written file (also used for batch manifests, result cache entries and benchmark captures).
+
+    temporaryPath = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporaryPath, 'wb') as outputFile:
+        save(outputFile)
+    os.replace(temporaryPath, path)
+
+def _userCacheDir(filePath):
+# Fallback cache folder for sources whose own folder is not writable (read-only shares): one folder per source folder
+# under the user's cache directory, so same named takes of different folders do not evict each other.
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    sourceDir = os.path.dirname(os.path.abspath(filePath))
+    return os.path.join(base, 'IMUdriftSimulator', CACHE_DIR_NAME.lstrip('.'), hashlib.sha256(sourceDir.encode()).hexdigest()[:16])
+
+def _writeCacheEntry(cacheDir, stem: str, basePath, header: dict, times: np.ndarray, readings: np.ndarray):
+# Stores one cache entry and removes the entries of older versions of the same source. Raises OSError when cacheDir is not writable.
+
+    os.makedirs(cacheDir, exist_ok=True)
+
+    entryName = re.compile(re.escape(stem) + r'-[0-9a-f]{16}(\.json|\.npy|\.times\.npy)$')     # not '<stem>-retake.trc' entries
+    for stalePath in glob.glob(os.path.join(glob.escape(cacheDir), glob.escape(stem) + '-*')):   # older versions of this source
+        if entryName.match(os.path.basename(stalePath)) and not stalePath.startswith(basePath):
+            try:
+                os.remove(stalePath)
+            except OSError:             # still open elsewhere, removed next time
+                pass
+
+    _saveAtomically(basePath + '.npy', lambda outputFile: np.save(outputFile, readings))
+    _saveAtomically(basePath + '.times.npy', lambda outputFile: np.save(outputFile, times))
+    _saveAtomically(basePath + '.json', lambda outputFile: outputFile.write(json.dumps(header).encode()))   # header last: marks the entry complete
+
+def _openCacheEntry(basePath):
+
+    with open(basePath + '.json', 'r') as headerFile:
+        header = json.load(headerFile)
+    header['HeaderLines'] = _newlineLines(header['HeaderLines'])     # entries cached before the header was normalized
+
+    return header, np.load(basePath + '.times.npy'), np.load(basePath + '.npy', mmap_mode='r')
+
+def loadTRCCached(filePath, cacheDir=None, keyByHash: bool = False):
+    # Purpose:
+    # Same result as readTRC, but the parsed arrays are kept in a binary cache next to the source
+    # (<name>-<key>.npy readings, .times.npy, .json header). Later loads memory-map the cache instead of parsing text,
+    # so every process that loads the same file shares the same pages.
+    # When the source folder is not writable the cache goes to the user's cache directory instead (see _userCacheDir),
+    # and when no cache folder is writable the file is parsed on every call.
+    # Parameters:
+    # cacheDir: where cache files go (default: CACHE_DIR_NAME next to the source).  keyByHash: key on a hash of the contents
+    # instead of size and modification time, for files whose mtime is not reliable (copies, network shares).
+    # Returns header, times, readings. readings is read-only, a memmap of the cache.
+
+    if cacheDir is None:
+        cacheDirs = [os.path.join(os.path.dirname(os.path.abspath(filePath)), CACHE_DIR_NAME), _userCacheDir(filePath)]
+    else:
+        cacheDirs = [cacheDir]
+    stem = os.path.splitext(os.path.basename(filePath))[0]
+    entryName = '%s-%s' % (stem, _sourceKey(filePath, keyByHash))
+
+    for directory in cacheDirs:
+        if os.path.exists(os.path.join(directory, entryName + '.json')):
+            return _openCacheEntry(os.path.join(directory, entryName))
+
+    header, times, readings = readTRC(filePath)
+    for directory in cacheDirs:
+        try:
+            _writeCacheEntry(directory, stem, os.path.join(directory, entryName), header, times, readings)
+        except OSError:                 # read-only folder, try the next one
+            continue
+        return _openCacheEntry(os.path.join(directory, entryName))
+
+    readings.flags.writeable = False    # no writable cache folder: the parsed arrays, read-only like the memmap
+    return header, times, readings